@@ -0,0 +1,265 @@
+"""
+Interchangeable implementations of the small numerical kernels which the
+navigators and the collision checks run every step. The NumPy backend is
+the reference and the default; the Numba backend compiles the same kernels
+to loops, which avoids NumPy's per-call overhead for the few tens of bodies
+of a typical scenario. It is only available if numba is installed.
+
+    from backends import set_backend
+    set_backend('numba')
+"""
+import numpy as np
+
+from math_utils import displacements, row_norms, pairwise_distances, overlap_mask, first_hit
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _pairwise(points, others):
+    """
+    Returns the (..., P, M, 3) displacements `points - others` and the
+    (..., P, M) distances between every row of `points` (..., P, 3) and every
+    row of `others` (..., M, 3). Any leading dimensions are broadcast.
+    """
+    diff = displacements(points, others)
+    return diff, row_norms(diff)
+
+
+class NumpyBackend:
+    """
+    The reference kernels, written with NumPy. They also take any leading
+    dimensions (e.g. the environments of an Ensemble) and masks.
+    """
+    name = 'numpy'
+
+    @staticmethod
+    def exp_repulsion(points, point_radii, others, others_radii, mask=None, exclude_coincident=False, cutoff=None):
+        """
+        Returns the (..., P, 3) sum over `others` of exp(-7 * gap) *
+        (point - other), where gap is the distance between the surfaces of
+        the two spheres. Only pairs selected by `mask` (broadcastable to
+        (..., P, M)) contribute, and `exclude_coincident` drops pairs at the
+        same position (i.e. a spaceship and itself). If `cutoff` is set,
+        pairs with a gap of `cutoff` or more are dropped as well.
+        """
+        diff, dist = _pairwise(points, others)
+        gap = dist - others_radii[..., None, :] - point_radii[..., :, None]
+        # The weights, and so the sum, are float64 even for float32 inputs.
+        weight = np.exp(-7 * np.asarray(gap, dtype=np.float64))
+
+        if mask is not None:
+            weight = np.where(mask, weight, 0.)
+        if exclude_coincident:
+            weight = np.where(np.all(diff == 0, axis=-1), 0., weight)
+        if cutoff is not None:
+            weight = np.where(gap < cutoff, weight, 0.)
+        return np.sum(weight[..., None] * diff, axis=-2)
+
+    @staticmethod
+    def inverse_repulsion(points, others, threshold, mask=None, exclude_coincident=False):
+        """
+        Returns the (..., P, 3) sum of 1 / (point - other) over the `others`
+        closer than `threshold` (broadcastable to (..., P, M)). `mask` and
+        `exclude_coincident` are as for `exp_repulsion`.
+        """
+        diff, dist = _pairwise(points, others)
+        near = dist < threshold
+
+        if mask is not None:
+            near &= mask
+        if exclude_coincident:
+            near &= ~np.all(diff == 0, axis=-1)
+
+        with np.errstate(divide='ignore'):
+            return np.sum(np.where(near[..., None], 1/diff, 0.), axis=-2, dtype=np.float64)
+
+    @staticmethod
+    def first_overlap(points, point_radii, others, others_radii):
+        """
+        Returns the (P,) index of the first of the spheres `others` (with
+        `others_radii`) which touches or overlaps each of the spheres
+        `points` (with `point_radii`), or -1 where there is none.
+        """
+        return first_hit(overlap_mask(pairwise_distances(points, others), point_radii, others_radii))
+
+    @staticmethod
+    def sanitise(positions, lows, highs):
+        """
+        Returns `positions` clipped to the box [`lows`, `highs`].
+        """
+        return np.clip(positions, lows, highs)
+
+
+# The loops compiled by the Numba backend. They are plain Python (and so
+# very slow) until compiled.
+
+def _exp_repulsion_loop(points, point_radii, others, others_radii, exclude_coincident, cutoff):
+    result = np.zeros((points.shape[0], 3))
+    for i in range(points.shape[0]):
+        for j in range(others.shape[0]):
+            d0 = points[i, 0] - others[j, 0]
+            d1 = points[i, 1] - others[j, 1]
+            d2 = points[i, 2] - others[j, 2]
+            if exclude_coincident and d0 == 0 and d1 == 0 and d2 == 0:
+                continue
+            gap = np.sqrt(d0 * d0 + d1 * d1 + d2 * d2) - others_radii[j] - point_radii[i]
+            if gap >= cutoff:
+                continue
+            weight = np.exp(-7 * gap)
+            result[i, 0] += weight * d0
+            result[i, 1] += weight * d1
+            result[i, 2] += weight * d2
+    return result
+
+
+def _inverse_repulsion_loop(points, others, threshold, exclude_coincident):
+    result = np.zeros((points.shape[0], 3))
+    for i in range(points.shape[0]):
+        for j in range(others.shape[0]):
+            d0 = points[i, 0] - others[j, 0]
+            d1 = points[i, 1] - others[j, 1]
+            d2 = points[i, 2] - others[j, 2]
+            if exclude_coincident and d0 == 0 and d1 == 0 and d2 == 0:
+                continue
+            if np.sqrt(d0 * d0 + d1 * d1 + d2 * d2) < threshold[i, j]:
+                result[i, 0] += 1 / d0
+                result[i, 1] += 1 / d1
+                result[i, 2] += 1 / d2
+    return result
+
+
+def _first_overlap_loop(points, point_radii, others, others_radii):
+    result = np.full(points.shape[0], -1)
+    for i in range(points.shape[0]):
+        for j in range(others.shape[0]):
+            d0 = points[i, 0] - others[j, 0]
+            d1 = points[i, 1] - others[j, 1]
+            d2 = points[i, 2] - others[j, 2]
+            if np.sqrt(d0 * d0 + d1 * d1 + d2 * d2) <= point_radii[i] + others_radii[j]:
+                result[i] = j
+                break
+    return result
+
+
+def _sanitise_loop(positions, lows, highs):
+    result = np.empty_like(positions)
+    for i in range(positions.shape[0]):
+        for k in range(positions.shape[1]):
+            result[i, k] = min(max(positions[i, k], lows[k]), highs[k])
+    return result
+
+
+class NumbaBackend(NumpyBackend):
+    """
+    The kernels compiled with Numba for (P, 3) points, so that a kernel is a
+    single call without temporaries. Calls with leading dimensions or masks
+    (as from an Ensemble) use the NumPy kernels. The results match those of
+    the NumPy backend up to rounding, as sums are accumulated in a
+    different order.
+    """
+    name = 'numba'
+
+    def __init__(self):
+        # Division by zero gives inf, as in NumPy, rather than raising.
+        jit = numba.njit(cache=True, error_model='numpy')
+        self._exp_repulsion = jit(_exp_repulsion_loop)
+        self._inverse_repulsion = jit(_inverse_repulsion_loop)
+        self._first_overlap = jit(_first_overlap_loop)
+        self._sanitise = jit(_sanitise_loop)
+
+    def exp_repulsion(self, points, point_radii, others, others_radii, mask=None, exclude_coincident=False,
+                      cutoff=None):
+        if mask is not None or np.ndim(points) != 2:
+            return NumpyBackend.exp_repulsion(points, point_radii, others, others_radii, mask, exclude_coincident,
+                                              cutoff)
+        return self._exp_repulsion(_floats(points), _floats(point_radii), _floats(others), _floats(others_radii),
+                                   exclude_coincident, np.inf if cutoff is None else float(cutoff))
+
+    def inverse_repulsion(self, points, others, threshold, mask=None, exclude_coincident=False):
+        if mask is not None or np.ndim(points) != 2:
+            return NumpyBackend.inverse_repulsion(points, others, threshold, mask, exclude_coincident)
+        threshold = np.broadcast_to(_floats(threshold), (len(points), len(others)))
+        return self._inverse_repulsion(_floats(points), _floats(others), threshold, exclude_coincident)
+
+    def first_overlap(self, points, point_radii, others, others_radii):
+        return self._first_overlap(_floats(points), _floats(point_radii), _floats(others), _floats(others_radii))
+
+    def sanitise(self, positions, lows, highs):
+        if np.ndim(positions) != 2:
+            return NumpyBackend.sanitise(positions, lows, highs)
+        return self._sanitise(_floats(positions), _floats(lows), _floats(highs))
+
+
+def _floats(a):
+    return np.asarray(a, dtype=float)
+
+
+_BACKENDS = {'numpy': NumpyBackend}
+if numba is not None:
+    _BACKENDS['numba'] = NumbaBackend
+
+_backend = NumpyBackend()
+
+
+def available_backends():
+    """
+    Returns the names of the backends which can be used here.
+    """
+    return list(_BACKENDS)
+
+
+def get_backend():
+    """
+    Returns the backend in use.
+    """
+    return _backend
+
+
+def set_backend(name):
+    """
+    Selects the backend `name` ('numpy' or, if numba is installed, 'numba')
+    for all subsequent kernel calls and returns it.
+    """
+    global _backend
+    assert name in _BACKENDS, f"Unknown or unavailable backend {name}; available: {available_backends()}."
+    if _backend.name != name:
+        _backend = _BACKENDS[name]()
+    return _backend
+
+
+def check_backend(name, rng=None, rtol=1e-9):
+    """
+    Checks that every kernel of the backend `name` matches the NumPy
+    reference, within `rtol` (relative to the largest value of each
+    result), on random points which include coincident and overlapping
+    pairs. Raises an AssertionError naming the kernel if one does not.
+    """
+    assert name in _BACKENDS, f"Unknown or unavailable backend {name}; available: {available_backends()}."
+    backend, reference = _BACKENDS[name](), NumpyBackend()
+    rng = rng if rng is not None else np.random.default_rng(0)
+
+    points = rng.uniform(-2., 2., size=(20, 3))
+    others = np.concatenate([points[:5], rng.uniform(-2., 2., size=(25, 3))])
+    point_radii = rng.uniform(0.05, 0.5, size=len(points))
+    others_radii = rng.uniform(0.05, 0.5, size=len(others))
+    threshold = rng.uniform(0.5, 2., size=(len(points), len(others)))
+    lows, highs = np.full(3, -1.), np.full(3, 1.)
+
+    kernels = {
+        'exp_repulsion': lambda b: b.exp_repulsion(points, point_radii, others, others_radii,
+                                                   exclude_coincident=True),
+        'exp_repulsion with cutoff': lambda b: b.exp_repulsion(points, point_radii, others, others_radii,
+                                                               exclude_coincident=True, cutoff=0.5),
+        'inverse_repulsion': lambda b: b.inverse_repulsion(points, others, threshold, exclude_coincident=True),
+        'first_overlap': lambda b: b.first_overlap(points, point_radii, others, others_radii),
+        'sanitise': lambda b: b.sanitise(points, lows, highs),
+    }
+    for kernel, call in kernels.items():
+        result, expected = call(backend), call(reference)
+        assert result.shape == expected.shape, f"{name} {kernel} returned shape {result.shape}, not {expected.shape}."
+        error = np.max(np.abs(result - expected), initial=0.)
+        scale = np.max(np.abs(expected), initial=1.)
+        assert error <= rtol * scale, f"{name} {kernel} differs from the NumPy reference by {error}."
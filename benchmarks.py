@@ -0,0 +1,242 @@
+"""
+Benchmarks for the simulation, navigation and sampling hot paths.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --baseline results.json --threshold 0.2
+    python benchmarks.py --backend numba
+    python benchmarks.py --check-backends
+
+Every benchmark runs on environments sampled from fixed seeds and records its
+best time over `--repeats` runs, plus the peak memory allocated while it ran
+(measured separately, as tracing allocations slows the code down). Results
+are written as JSON; with `--baseline`, they are compared against an earlier
+results file and the script exits with status 1 if any benchmark is slower
+than its baseline by more than `--threshold` (a fraction). `--backend` selects
+the kernel backend (see `backends`), which is first checked against the NumPy
+reference; `--check-backends` only checks every backend, skipping those which
+are not installed.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from backends import available_backends, check_backend, get_backend, set_backend
+from components import *
+from experiments import sample_environment
+from potential_field_navigator import *
+
+
+SEED = 0
+BACKENDS = ('numpy', 'numba')
+NAVIGATORS = (PotentialFieldNavigator, BasicPotentialFieldNavigator, ProposedPotentialFieldNavigator)
+
+# Number of spaceships (and asteroids) in the environments stepped by the
+# `run` benchmarks; --quick only uses the smaller ones.
+BODY_COUNTS = (10, 100, 1000, 10000)
+QUICK_BODY_COUNTS = (10, 100)
+DTS = (0.01, 0.05)
+
+# Number of steps simulated by each `run` benchmark, whatever its dt.
+N_STEPS = 20
+
+# Side of the environment for 10 spaceships; it grows with the number of
+# bodies so that their density, and so the amount of avoidance, stays the same.
+BASE_SIZE = 10.
+SPACESHIP_RADIUS = 0.05
+ASTEROID_RADIUS = 0.1
+PLANET_RADIUS = 1.
+
+
+def _environment(n_bodies, dt, navigator, seed=SEED):
+    size = BASE_SIZE * (n_bodies / 10) ** (1 / 3)
+    env = sample_environment(size, size, size, 3, n_bodies, n_bodies, SPACESHIP_RADIUS, dt, navigator,
+                             asteroid_radius=ASTEROID_RADIUS, planet_radius=PLANET_RADIUS,
+                             cell_size=4 * PLANET_RADIUS, rng=np.random.default_rng(seed),
+                             packed=n_bodies > 100, horizon=N_STEPS * dt)
+    return env
+
+
+def _measure(setup, fn, repeats):
+    """
+    Returns the best time of `repeats` calls of `fn(setup())` (excluding
+    `setup`) and the peak memory allocated by one more call.
+    """
+    best = np.inf
+    for _ in range(repeats):
+        arg = setup()
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+
+    arg = setup()
+    tracemalloc.start()
+    try:
+        fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def benchmark_run(body_counts, repeats):
+    results = {}
+    for navigator_cls in NAVIGATORS:
+        for n_bodies in body_counts:
+            for dt in DTS:
+                name = f'run/{navigator_cls.__name__}/n={n_bodies}/dt={dt}'
+                seconds, peak = _measure(lambda: _environment(n_bodies, dt, navigator_cls()),
+                                         lambda env: env.run(collision_policy=RECORD_COLLISIONS), repeats)
+                results[name] = {'seconds': seconds, 'steps_per_sec': N_STEPS / seconds, 'peak_bytes': peak}
+    return results
+
+
+def benchmark_evaluate_collisions(body_counts, repeats):
+    def setup(n_bodies):
+        env = _environment(n_bodies, DTS[0], ProposedPotentialFieldNavigator())
+        env.run(collision_policy=RECORD_COLLISIONS)
+        env._trajectory_grids = (None, {})
+        return env
+
+    results = {}
+    for n_bodies in body_counts:
+        seconds, peak = _measure(lambda: setup(n_bodies), lambda env: env._evaluate_collisions(), repeats)
+        results[f'evaluate_collisions/n={n_bodies}'] = {'seconds': seconds, 'peak_bytes': peak}
+    return results
+
+
+def benchmark_sampling(body_counts, repeats):
+    results = {}
+    for n_bodies in body_counts:
+        for packed in (False, True):
+            if n_bodies > 1000 and not packed:
+                # One body at a time is quadratic in the number of bodies.
+                continue
+
+            size = BASE_SIZE * (n_bodies / 10) ** (1 / 3)
+            sample = lambda rng: sample_environment(size, size, size, 3, n_bodies, n_bodies, SPACESHIP_RADIUS,
+                                                    DTS[0], ProposedPotentialFieldNavigator(),
+                                                    asteroid_radius=ASTEROID_RADIUS, planet_radius=PLANET_RADIUS,
+                                                    rng=rng, packed=packed)
+            seconds, peak = _measure(lambda: np.random.default_rng(SEED), sample, repeats)
+            results[f'sample_environment/n={n_bodies}/packed={packed}'] = {'seconds': seconds, 'peak_bytes': peak}
+    return results
+
+
+def benchmark_plot_potential_field(repeats):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from visualisation import plot_potential_field
+
+    def plot(env):
+        plot_potential_field(env, 0)
+        plt.close('all')
+
+    results = {}
+    for navigator_cls in NAVIGATORS:
+        seconds, peak = _measure(lambda: _environment(10, DTS[0], navigator_cls()), plot, repeats)
+        results[f'plot_potential_field/{navigator_cls.__name__}'] = {'seconds': seconds, 'peak_bytes': peak}
+    return results
+
+
+def benchmark_plot_env(body_counts, repeats):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from visualisation import plot_env
+
+    def setup(n_bodies):
+        env = _environment(n_bodies, DTS[0], ProposedPotentialFieldNavigator())
+        env.run(collision_policy=RECORD_COLLISIONS)
+        return env
+
+    results = {}
+    for n_bodies in body_counts:
+        for batched in (False, True):
+            def plot(env):
+                plot_env(env, batched=batched)
+                plt.gcf().canvas.draw()
+                plt.close('all')
+
+            seconds, peak = _measure(lambda: setup(n_bodies), plot, repeats)
+            results[f'plot_env/n={n_bodies}/batched={batched}'] = {'seconds': seconds, 'peak_bytes': peak}
+    return results
+
+
+def run_benchmarks(quick=False, repeats=3):
+    body_counts = QUICK_BODY_COUNTS if quick else BODY_COUNTS
+    results = {}
+    results.update(benchmark_run(body_counts, repeats))
+    results.update(benchmark_evaluate_collisions(body_counts, repeats))
+    results.update(benchmark_sampling(body_counts, repeats))
+    results.update(benchmark_plot_potential_field(repeats))
+    results.update(benchmark_plot_env(QUICK_BODY_COUNTS, repeats))
+    return {'meta': {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+                     'seed': SEED, 'quick': quick, 'repeats': repeats, 'backend': get_backend().name},
+            'results': results}
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the list of (name, seconds, baseline seconds) of the benchmarks
+    in both `results` and `baseline` which are more than `threshold` (a
+    fraction) slower than their baseline.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is not None and result['seconds'] > reference['seconds'] * (1 + threshold):
+            regressions.append((name, result['seconds'], reference['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='File to write the results to as JSON.')
+    parser.add_argument('--baseline', help='Results file to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fraction by which a benchmark may be slower than its baseline.')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='Only use the smaller environments.')
+    parser.add_argument('--backend', default='numpy', choices=available_backends(), help='Kernel backend to use.')
+    parser.add_argument('--check-backends', action='store_true',
+                        help='Only check that every backend matches the NumPy reference.')
+    args = parser.parse_args(argv)
+
+    if args.check_backends:
+        for name in BACKENDS:
+            if name not in available_backends():
+                print(f'{name}: skipped (not installed)')
+                continue
+            check_backend(name)
+            print(f'{name}: ok')
+        return 0
+
+    check_backend(args.backend)
+    set_backend(args.backend)
+
+    results = run_benchmarks(quick=args.quick, repeats=args.repeats)
+    for name, result in results['results'].items():
+        print(f"{name:70s} {result['seconds'] * 1e3:10.2f} ms {result['peak_bytes'] / 2**20:8.2f} MiB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, seconds, reference in regressions:
+            print(f'REGRESSION {name}: {seconds * 1e3:.2f} ms vs {reference * 1e3:.2f} ms')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Checkpoints of the full simulation state of an Environment, so that a run
+can be resumed from the middle, or forked into several what-if
+continuations (e.g. with another navigator or `dt`), without simulating the
+shared prefix again.
+
+    sink = CheckpointSink(times=[2.5])
+    for _ in env.run_iter(sinks=[sink]):
+        pass
+    envs = fork(sink.checkpoints[0], {'basic': {'navigator': BasicPotentialFieldNavigator()},
+                                      'coarse': {'dt': 0.05}})
+    for env in envs.values():
+        env.run(collision_policy=RECORD_COLLISIONS)
+"""
+import copy
+import gzip
+import os
+import pickle
+
+import numpy as np
+
+from components import *
+from trajectories import TrajectoryBuffer
+
+
+# The bodies of each kind, with the fields stored for each.
+_BODIES = (('planet', Planet, ('position', 'radius')),
+           ('asteroid', Asteroid, ('position', 'radius', 'velocity')),
+           ('spaceship', Spaceship, ('position', 'radius', 'goal')))
+
+
+def _rng_state(rng):
+    """
+    Returns the state of `rng`, a numpy.random.Generator or the numpy.random
+    module (i.e. the global state).
+    """
+    if rng is np.random:
+        return None, np.random.get_state()
+    return type(rng.bit_generator).__name__, rng.bit_generator.state
+
+
+def _restore_rng(rng_state):
+    """
+    Returns a new Generator with the state returned by `_rng_state`, or sets
+    the global state and returns the numpy.random module.
+    """
+    bit_generator, state = rng_state
+    if bit_generator is None:
+        np.random.set_state(state)
+        return np.random
+    rng = np.random.Generator(getattr(np.random, bit_generator)())
+    rng.bit_generator.state = state
+    return rng
+
+
+class Checkpoint:
+    """
+    A copy of the full simulation state of an Environment at time `t`: its
+    dimensions and settings, navigator, bodies, trajectories so far (if
+    kept), collisions and stops recorded so far, the asteroid positions it
+    had computed ahead and the state of its random number generator. It
+    shares no mutable state with the environment, which can carry on
+    running. See `checkpoint`, `restore` and `fork`.
+
+    Checkpoints are held in memory, or written to disk with `save` (as a
+    gzip-compressed pickle, so only `load` files you trust).
+    """
+    def __init__(self, settings, bodies, trajectories, state, asteroid_plan, rng_state):
+        self.settings = settings
+        self.bodies = bodies
+        self.trajectories = trajectories
+        self.state = state
+        self.asteroid_plan = asteroid_plan
+        self.rng_state = rng_state
+
+    @property
+    def t(self):
+        return self.state['t']
+
+    def save(self, filename, compresslevel=6):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with gzip.open(filename, 'wb', compresslevel=compresslevel) as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with gzip.open(filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+        assert isinstance(checkpoint, cls), f"{filename} does not hold a checkpoint."
+        return checkpoint
+
+
+def checkpoint(env, keep_trajectories=True):
+    """
+    Returns a Checkpoint of `env` at its current time. If `keep_trajectories`
+    is False, only the latest positions of the trajectories are kept, which
+    is enough to carry on running (as with `run_iter(keep_trajectories=False)`)
+    and much smaller for long runs.
+    """
+    settings = {'xlen': env.xlen, 'ylen': env.ylen, 'zlen': env.zlen, 'dt': env.dt, 'horizon': env.horizon,
+                'dt_range': env.dt_range, 'cell_size': env.cell_size, 'neighbour_skin': env.neighbour_skin,
+                'dtype': env.dtype, 'navigator': copy.deepcopy(env.navigator)}
+    bodies = {kind: {name: env._body_arrays(kind).field(name).copy() for name in fields}
+              for kind, _, fields in _BODIES}
+
+    trajectories = {}
+    for kind, buffer in (('asteroid', env._asteroid_trajectories), ('spaceship', env._spaceship_trajectories)):
+        start = 0 if keep_trajectories else len(buffer) - 1
+        trajectories[kind] = (buffer.array[start:].copy(), buffer.times[start:].copy(),
+                              buffer.n_discarded + start)
+
+    state = {'t': env._t, 'last_dt': env._last_dt, 'speeds': env._speeds, 'collisions': copy.deepcopy(env._collisions),
+             'collision_times': dict(env.collision_times), 'frozen': set(env._frozen),
+             'arrival_times': dict(env.arrival_times), 'stall_times': dict(env.stall_times)}
+
+    # Only the rows of the asteroid table which have not been used yet, and
+    # only if it still matches the asteroids.
+    version, table, index = env._asteroid_plan
+    asteroid_plan = None
+    if table is not None and version == env._asteroid_arrays.version and index < len(table):
+        asteroid_plan = table[index:].copy()
+
+    return Checkpoint(settings, bodies, trajectories, state, asteroid_plan, _rng_state(env.rng))
+
+
+def restore(checkpoint, navigator=None, dt=None, horizon=None, dt_range=None, instrumentation=None):
+    """
+    Returns a new Environment in the state of `checkpoint`, which carries on
+    from the checkpoint's time when run: with the same settings, it gives
+    the same results as the environment the checkpoint was taken of. Any of
+    `navigator`, `dt`, `horizon` and `dt_range` which are given replace
+    those of the checkpoint (a `dt_range` of False switches adaptive steps
+    off). The environment gets a copy of the checkpoint's navigator and its
+    own random number generator in the checkpoint's state, or, if the
+    environment used the global numpy state, that state is reset to the
+    checkpoint's.
+
+    If the checkpoint's trajectories had dropped their history (see
+    `checkpoint` and `run_iter(keep_trajectories=False)`), the restored
+    trajectories are not preallocated up to the horizon either.
+
+    Stall detection (see `Environment.run`) starts afresh on the restored
+    environment, so with `early_stop` a spaceship is only flagged as stalled
+    after another `stall_window * dt` of simulated time.
+    """
+    settings = checkpoint.settings
+    dt = dt if dt is not None else settings['dt']
+    horizon = horizon if horizon is not None else settings['horizon']
+    dt_range = settings['dt_range'] if dt_range is None else dt_range or None
+
+    body_lists = {}
+    for kind, body_cls, fields in _BODIES:
+        values = checkpoint.bodies[kind]
+        body_lists[kind] = [body_cls(*(values[name][i].copy() for name in fields))
+                            for i in range(len(values['radius']))]
+
+    env = Environment(settings['xlen'], settings['ylen'], settings['zlen'], body_lists['spaceship'],
+                      body_lists['asteroid'], body_lists['planet'], dt,
+                      navigator if navigator is not None else copy.deepcopy(settings['navigator']),
+                      cell_size=settings['cell_size'], rng=_restore_rng(checkpoint.rng_state), horizon=horizon,
+                      dt_range=dt_range, instrumentation=instrumentation,
+                      neighbour_skin=settings['neighbour_skin'], dtype=settings['dtype'])
+
+    state = checkpoint.state
+    for kind, attr in (('asteroid', '_asteroid_trajectories'), ('spaceship', '_spaceship_trajectories')):
+        array, times, n_discarded = checkpoint.trajectories[kind]
+        # Room for the steps left until the horizon, as in Environment, unless
+        # the history was being discarded, in which case it will be again.
+        capacity = None
+        if dt_range is None and n_discarded == 0:
+            capacity = len(array) + int(np.ceil((horizon - state['t']) / dt)) + 2
+        buffer = TrajectoryBuffer.from_array(array, capacity, times=times, dtype=settings['dtype'])
+        buffer.n_discarded = n_discarded
+        setattr(env, attr, buffer)
+
+    env._t = state['t']
+    env._last_dt = state['last_dt']
+    env._speeds = state['speeds']
+    env._collisions = copy.deepcopy(state['collisions'])
+    env.collision_times = dict(state['collision_times'])
+    env._frozen = set(state['frozen'])
+    env.arrival_times = dict(state['arrival_times'])
+    env.stall_times = dict(state['stall_times'])
+
+    # The table was computed for the checkpoint's `dt`.
+    if checkpoint.asteroid_plan is not None and dt == settings['dt']:
+        env._asteroid_plan = (env._asteroid_arrays.version, checkpoint.asteroid_plan.copy(), 0)
+    return env
+
+
+def fork(checkpoint, variants):
+    """
+    Restores `checkpoint` once per entry of `variants`, a dict of name to a
+    dict of keyword arguments for `restore` (e.g. {'navigator': ...} or
+    {'dt': ...}), and returns a dict of name to Environment. The
+    environments share no state, so they can be run independently.
+    """
+    return {name: restore(checkpoint, **overrides) for name, overrides in variants.items()}
+
+
+class CheckpointSink:
+    """
+    A sink for `Environment.run_iter` (see sinks.py) which takes a
+    Checkpoint of the environment at the first state at or after each of
+    `times`. Checkpoints are kept in `checkpoints`, or, if `directory` is
+    given, saved there as `checkpoint_<index>.pkl.gz` and their file names
+    kept instead. `keep_trajectories` is as for `checkpoint`.
+    """
+    def __init__(self, times, directory=None, keep_trajectories=True):
+        self.times = np.sort(np.asarray(times, dtype=float))
+        self.directory = directory
+        self.keep_trajectories = keep_trajectories
+        self.checkpoints = []
+
+    def open(self, env):
+        self._env = env
+        self._next = 0
+
+    def write(self, state):
+        if self._next == len(self.times) or state.t < self.times[self._next] - TIME_TOLERANCE:
+            return
+        self._next = int(np.searchsorted(self.times, state.t + TIME_TOLERANCE, side='right'))
+
+        saved = checkpoint(self._env, self.keep_trajectories)
+        if self.directory is not None:
+            filename = os.path.join(self.directory, f'checkpoint_{len(self.checkpoints):05d}.pkl.gz')
+            saved.save(filename)
+            saved = filename
+        self.checkpoints.append(saved)
+
+    def close(self):
+        self._env = None
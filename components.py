@@ -1,46 +1,234 @@
 from __future__ import annotations
 
+import copy
+from collections import deque, namedtuple
+
 import numpy as np
 
-from math_utils import euclidean_distance, spherical_collision
+from backends import get_backend
+from instrumentation import NULL_INSTRUMENTATION
+from math_utils import euclidean_distance, swept_sphere_contact, row_norms, pairwise_distances, overlap_mask
+from sampling import MAX_SAMPLE_ATTEMPTS, dart_throwing, overlapping, rejection_sample
+from spatial_index import UniformGrid, pairs_within
+from trajectories import TrajectoryBuffer
 
 
 ASTEROID_COLLISION = 0
 PLANET_COLLISION = 1
 SPACESHIP_COLLISION = 2
 
+# Policies for collisions detected while `Environment.run` is stepping.
+RECORD_COLLISIONS = 'record' # Record each spaceship's first collision and carry on.
+FREEZE_COLLIDED = 'freeze'   # As above, but collided spaceships stop moving.
+ABORT_ON_COLLISION = 'abort' # Stop the run at the first collision.
+COLLISION_POLICIES = (RECORD_COLLISIONS, FREEZE_COLLIDED, ABORT_ON_COLLISION)
 
-class Planet:
-    def __init__(self, position, radius):
-        self.position = position
-        self.radius = radius
+# How collisions are detected while `Environment.run` is stepping.
+DISCRETE_COLLISIONS = 'discrete' # Overlap at the positions after each step.
+SWEPT_COLLISIONS = 'swept'       # Contact at any point during each step.
 
 
-class Spaceship:
-    def __init__(self, position, radius, goal):
-        self.position = position
-        self.radius = radius
-        self.goal = goal
+INITIAL_CAPACITY = 8
+
+# A spaceship within this distance of its goal has arrived.
+GOAL_TOLERANCE = 0.1
+
+# With early stopping, a spaceship which has moved less than STALL_DISTANCE
+# over the last STALL_WINDOW steps is taken to be stuck (e.g. in a local
+# minimum of the potential field).
+STALL_WINDOW = 20
+STALL_DISTANCE = 0.1
+
+# With adaptive stepping, the fraction of its clearance by which a spaceship
+# may close on any other body in a single step.
+ADAPTIVE_SAFETY = 0.5
+
+# Maximum number of fixed-length steps of asteroid positions computed at once
+# by `Environment._precompute_asteroids`.
+ASTEROID_PLAN_STEPS = 256
+
+# Times closer together than this are taken to be the same time, so that
+# rounding in the accumulated time does not move `state_at_time` by a step.
+TIME_TOLERANCE = 1e-9
+
+# The state yielded by `Environment.run_iter` after every step: the time, copies
+# of the (N, 3) spaceship and (M, 3) asteroid positions, and the list of
+# collisions first detected at that step.
+StepState = namedtuple('StepState', ['t', 'spaceship_positions', 'asteroid_positions', 'collisions'])
+
+
+class BodyArrays:
+    """
+    Structure-of-arrays storage for one kind of body. Every body has a
+    `position` (N, 3) and a `radius` (N,) entry, and `vector_fields` names
+    any additional per-body 3-vectors (e.g. `velocity` or `goal`). The
+    underlying buffers grow geometrically, so appending is amortised O(1).
+
+    `version` is incremented whenever the stored values change, so that
+    derived structures (e.g. spatial indices) know when to rebuild. Code which
+    writes into the arrays returned by `field` must call `touch`. Values are
+    stored as `dtype`.
+    """
+    def __init__(self, vector_fields=(), dtype=np.float64):
+        self.n = 0
+        self.version = 0
+        self._data = {'position': np.empty((0, 3), dtype=dtype), 'radius': np.empty((0,), dtype=dtype)}
+        for name in vector_fields:
+            self._data[name] = np.empty((0, 3), dtype=dtype)
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, capacity):
+        for name, arr in self._data.items():
+            new_arr = np.empty((capacity, *arr.shape[1:]), dtype=arr.dtype)
+            new_arr[:self.n] = arr[:self.n]
+            self._data[name] = new_arr
+
+    def field(self, name):
+        """
+        Returns a view of the first `n` rows of the field `name`.
+        """
+        return self._data[name][:self.n]
+
+    @property
+    def positions(self):
+        return self.field('position')
+
+    @property
+    def radii(self):
+        return self.field('radius')
+
+    def get(self, name, idx):
+        return self._data[name][idx]
+
+    def set(self, name, idx, value):
+        self._data[name][idx] = value
+        self.version += 1
+
+    def touch(self):
+        self.version += 1
+
+    def append(self, **values):
+        """
+        Appends a body whose fields are given as keyword arguments and
+        returns its index.
+        """
+        if self.n == len(self._data['radius']):
+            self._grow(max(INITIAL_CAPACITY, 2 * self.n))
+
+        for name, value in values.items():
+            self._data[name][self.n] = value
+        self.n += 1
+        self.version += 1
+        return self.n - 1
+
+
+def _body_field(name):
+    def getter(self):
+        if self._store is None:
+            return self._values[name]
+        return self._store.get(name, self._idx)
+
+    def setter(self, value):
+        if self._store is None:
+            self._values[name] = value
+        else:
+            self._store.set(name, self._idx, value)
+
+    return property(getter, setter)
+
+
+class _Body:
+    """
+    A body which has not been added to an Environment keeps its own
+    attributes. Once added, it becomes a lightweight view onto a row of the
+    environment's BodyArrays, so that reads and writes go straight to the
+    contiguous storage.
+    """
+    _fields = ('position', 'radius')
+
+    position = _body_field('position')
+    radius = _body_field('radius')
+
+    def __init__(self, **values):
+        self._store = None
+        self._idx = None
+        self._values = values
+
+    def _bind(self, store):
+        values = {name: getattr(self, name) for name in self._fields}
+        self._idx = store.append(**values)
+        self._store = store
+        self._values = None
 
     def set_position(self, new_position):
         self.position = new_position
 
+
+class Planet(_Body):
+    def __init__(self, position, radius):
+        super().__init__(position=position, radius=radius)
+
+
+class Spaceship(_Body):
+    _fields = ('position', 'radius', 'goal')
+
+    goal = _body_field('goal')
+
+    def __init__(self, position, radius, goal):
+        super().__init__(position=position, radius=radius, goal=goal)
+
     def at_goal(self):
-        return euclidean_distance(self.position, self.goal) < 0.1
+        return euclidean_distance(self.position, self.goal) < GOAL_TOLERANCE
 
 
-class Asteroid:
-    def __init__(self, position, radius, velocity):
-        self.position = position
-        self.radius = radius
-        self.velocity = velocity
+class StallDetector:
+    """
+    Flags the spaceships whose displacement over the last `window` steps of
+    length `dt` is less than `distance`. The window is measured in simulated
+    time, so it covers the same span however long the steps actually are
+    (e.g. with adaptive steps). Keeps the positions within the window, with
+    their times, so it does not depend on the trajectories being kept.
+    """
+    def __init__(self, positions, window=STALL_WINDOW, distance=STALL_DISTANCE, dt=1., t0=0.):
+        self.window = window
+        self.distance = distance
+        self.span = window * dt
+        self._history = deque([(t0, np.array(positions, dtype=float))])
 
-    def set_position(self, new_position):
-        self.position = new_position
+    def update(self, positions, t):
+        """
+        Records the (N, 3) `positions` after a step, at time `t`, and returns
+        the (N,) mask of the spaceships which have stalled, i.e. moved less
+        than `distance` since the latest recorded time at least `span` ago.
+        """
+        history = self._history
+        cutoff = t - self.span + TIME_TOLERANCE
+        while len(history) > 1 and history[1][0] <= cutoff:
+            history.popleft()
+
+        start, start_positions = history[0]
+        if start <= cutoff:
+            stalled = row_norms(positions - start_positions) < self.distance
+        else:
+            stalled = np.zeros(len(positions), dtype=bool)
+        history.append((t, np.array(positions, dtype=float)))
+        return stalled
+
+
+class Asteroid(_Body):
+    _fields = ('position', 'radius', 'velocity')
+
+    velocity = _body_field('velocity')
+
+    def __init__(self, position, radius, velocity):
+        super().__init__(position=position, radius=radius, velocity=velocity)
 
 
 class Environment:
-    def __init__(self, xlen, ylen, zlen, spaceships, asteroids, planets, dt, navigator):
+    def __init__(self, xlen, ylen, zlen, spaceships, asteroids, planets, dt, navigator, cell_size=None, rng=None,
+                 horizon=1., dt_range=None, instrumentation=None, neighbour_skin=None, dtype=np.float64):
         self.xlen = xlen
         self.ylen = ylen
         self.zlen = zlen
@@ -48,31 +236,205 @@ class Environment:
         self.asteroids = asteroids
         self.planets = planets
         self.dt = dt
+        # The simulated time at which `run` stops.
+        self.horizon = horizon
+        # With `dt_range` = (dt_min, dt_max), the length of each step is
+        # chosen within those bounds (see `_adaptive_dt`), except that the
+        # last step ends at the horizon, and `dt` is only the reference step
+        # which sets the spaceships' speed. Spaceships which keep moving at
+        # their goals hold the steps to about `dt`, so use `early_stop` with
+        # adaptive steps.
+        self.dt_range = dt_range
+        # Profiling is opt-in: pass an `instrumentation.Instrumentation` to
+        # time the phases of each run and count the pair checks (see `stats`).
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
         self.navigator = navigator
-        self._spaceship_trajectories = [[s.position] for s in spaceships]
-        self._asteroid_trajectories = [[a.position] for a in asteroids]
+        self.cell_size = cell_size
+        # With `neighbour_skin` set, the spaceships' neighbours are kept in
+        # Verlet lists which are reused across steps (see
+        # `spaceship_neighbour_pairs`).
+        self.neighbour_skin = neighbour_skin
+        # Any randomness (sampling, navigator noise) is drawn from `rng`, a
+        # numpy.random.Generator, or from the global numpy state if not given.
+        self.rng = rng if rng is not None else np.random
+        # Positions, radii, velocities, goals and trajectories are stored as
+        # `dtype`; float32 halves their memory for very large swarms. Times,
+        # and the navigators' sums, are kept in float64.
+        self.dtype = np.dtype(dtype)
+
+        self._planet_arrays = BodyArrays(dtype=dtype)
+        self._asteroid_arrays = BodyArrays(('velocity',), dtype=dtype)
+        self._spaceship_arrays = BodyArrays(('goal',), dtype=dtype)
+        for planet in planets:
+            planet._bind(self._planet_arrays)
+        for asteroid in asteroids:
+            asteroid._bind(self._asteroid_arrays)
+        for spaceship in spaceships:
+            spaceship._bind(self._spaceship_arrays)
+
+        # Room for every step up to the horizon, plus one for rounding in `_t`.
+        # With adaptive steps the number of steps is not known in advance.
+        capacity = int(np.ceil(horizon / dt)) + 2 if dt_range is None else None
+        self._spaceship_trajectories = TrajectoryBuffer(self.spaceship_positions, capacity, dtype=dtype)
+        self._asteroid_trajectories = TrajectoryBuffer(self.asteroid_positions, capacity, dtype=dtype)
         self._t = 0
+        self._last_dt = dt
+        # With adaptive steps, the spaceships' speeds during the last step,
+        # from which the length of the next one is chosen.
+        self._speeds = None
+        # Asteroid positions computed ahead for the coming steps: the asteroid
+        # arrays' version when the plan was last used, the table and the
+        # index of the next step in it.
+        self._asteroid_plan = (None, None, 0)
+        self._grids = {}
+        self._neighbour_lists = {}
+        self._trajectory_grids = (None, {})
+        self._collisions = {}
+        self._frozen = set()
+        self.collision_times = {}
+        # With early stopping, the times at which spaceships arrived at their
+        # goals or stalled and so stopped being stepped.
+        self.arrival_times = {}
+        self.stall_times = {}
 
-    def _add_spaceship_pos(self, spaceship_idx, pos):
-        self._spaceship_trajectories[spaceship_idx].append(pos)
-    
-    def _add_asteroid_pos(self, asteroid_idx, pos):
-        self._asteroid_trajectories[asteroid_idx].append(pos)
+    @property
+    def planet_positions(self):
+        return self._planet_arrays.positions
+
+    @property
+    def planet_radii(self):
+        return self._planet_arrays.radii
+
+    @property
+    def asteroid_positions(self):
+        return self._asteroid_arrays.positions
+
+    @property
+    def asteroid_radii(self):
+        return self._asteroid_arrays.radii
+
+    @property
+    def asteroid_velocities(self):
+        return self._asteroid_arrays.field('velocity')
+
+    @property
+    def spaceship_positions(self):
+        return self._spaceship_arrays.positions
+
+    @property
+    def spaceship_radii(self):
+        return self._spaceship_arrays.radii
+
+    @property
+    def spaceship_goals(self):
+        return self._spaceship_arrays.field('goal')
+
+    def _body_arrays(self, kind):
+        return {'planet': self._planet_arrays,
+                'asteroid': self._asteroid_arrays,
+                'spaceship': self._spaceship_arrays}[kind]
+
+    def spatial_index(self, kind):
+        """
+        Returns a UniformGrid over the current positions of the bodies of
+        `kind` ('planet', 'asteroid' or 'spaceship'). The grid is cached and
+        only rebuilt once those bodies have moved or been added.
+        """
+        arrays = self._body_arrays(kind)
+        version, grid = self._grids.get(kind, (None, None))
+        if version != arrays.version:
+            grid = UniformGrid(arrays.positions, self.cell_size)
+            self._grids[kind] = (arrays.version, grid)
+        return grid
+
+    def neighbour_pairs(self, kind, points, r):
+        """
+        Returns index arrays (point_idx, body_idx) of every body of `kind`
+        whose centre is within `r` (a scalar or one radius per point) of a row
+        of the (P, 3) array `points`. Uses the spatial index if `cell_size` is
+        set and a brute-force search otherwise.
+        """
+        pairs = self._find_pairs(kind, points, r)
+        self.instrumentation.count('neighbour_pairs', len(pairs[0]))
+        return pairs
+
+    def _find_pairs(self, kind, points, r):
+        if self.cell_size is None:
+            return pairs_within(points, self._body_arrays(kind).positions, r)
+        return self.spatial_index(kind).query_pairs(points, r)
+
+    def spaceship_neighbour_pairs(self, kind, r):
+        """
+        Returns `neighbour_pairs(kind, self.spaceship_positions, r)`.
+
+        If `neighbour_skin` is set, the pairs are instead filtered from a
+        Verlet list of the pairs which were within r + skin of each other
+        when it was built (sorted by spaceship, then body). A pair can only
+        come within r without being listed once the spaceship has moved,
+        together with the furthest moved body of `kind`, by more than its
+        margin, so the list is reused until then (or until bodies are added)
+        and the search is mostly skipped, as bodies only move a little each
+        step. Lists are rebuilt with the largest `r` asked for since the
+        last build, so that callers with different radii share them.
+        """
+        positions = self.spaceship_positions
+        if self.neighbour_skin is None:
+            return self.neighbour_pairs(kind, positions, r)
+
+        r = np.broadcast_to(np.asarray(r, dtype=float), (len(positions),))
+        others = self._body_arrays(kind).positions
+        entry = self._neighbour_lists.get(kind)
+        rebuild = entry is None or len(entry[0]) != len(positions) or len(entry[1]) != len(others)
+        if rebuild:
+            needed = r
+        else:
+            start, others_start, reach, needed, point_idx, other_idx = entry
+            needed = np.maximum(needed, r)
+            drift = row_norms(positions - start) + np.max(row_norms(others - others_start), initial=0.)
+            rebuild = np.any(r + drift > reach)
+
+        if rebuild:
+            reach = needed + self.neighbour_skin
+            point_idx, other_idx = self._find_pairs(kind, positions, reach)
+            order = np.lexsort((other_idx, point_idx))
+            point_idx, other_idx = point_idx[order], other_idx[order]
+            start, others_start, needed = positions.copy(), others.copy(), r
+            self.instrumentation.count('neighbour_list_builds')
+        self._neighbour_lists[kind] = (start, others_start, reach, needed, point_idx, other_idx)
+
+        within = row_norms(positions[point_idx] - others[other_idx]) <= r[point_idx]
+        self.instrumentation.count('neighbour_pairs', np.sum(within))
+        return point_idx[within], other_idx[within]
+
+    def _collision_candidates(self, kind, index, pos, r):
+        """
+        Returns the sorted indices of the bodies of `kind` whose centre at
+        trajectory index `index` is within `r` of `pos`. Without a spatial
+        index every body is a candidate.
+        """
+        n = len(self._body_arrays(kind))
+        if self.cell_size is None:
+            return range(n)
+
+        if kind == 'planet':
+            return self.spatial_index('planet').query(pos, r).tolist()
+
+        cached_index, grids = self._trajectory_grids
+        if cached_index != index:
+            grids = {}
+            self._trajectory_grids = (index, grids)
+        if kind not in grids:
+            trajectories = (self._asteroid_trajectories if kind == 'asteroid'
+                            else self._spaceship_trajectories)
+            grids[kind] = UniformGrid(trajectories.positions_at(index), self.cell_size)
+        return grids[kind].query(pos, r).tolist()
 
     def _inside_obj(self, pos):
         """
         Returns True if `pos` is inside a Planet, Asteroid or Spaceship.
         """
-        for planet in self.planets:
-            if euclidean_distance(pos, planet.position) <= planet.radius:
-                return True
-        
-        for asteroid in self.asteroids:
-            if euclidean_distance(pos, asteroid.position) <= asteroid.radius:
-                return True
-            
-        for spaceship in self.spaceships:
-            if euclidean_distance(pos, spaceship.position) <= spaceship.radius:
+        for arrays in (self._planet_arrays, self._asteroid_arrays, self._spaceship_arrays):
+            if np.any(row_norms(arrays.positions - pos) <= arrays.radii):
                 return True
 
         return False
@@ -81,12 +443,15 @@ class Environment:
         """
         Returns True if `pos` is inside a planet. False otherwise.
         """
-        for planet in self.planets:
-            dist = euclidean_distance(pos, planet.position)
-            if dist < planet.radius:
-                return True
-        
-        return False
+        return bool(self._inside_planet_batch(pos[None, :])[0])
+
+    def _inside_planet_batch(self, positions):
+        """
+        Vectorised `_inside_planet` for an (N, 3) array of positions.
+        Returns an (N,) boolean mask.
+        """
+        dists = pairwise_distances(positions, self.planet_positions)
+        return np.any(overlap_mask(dists, np.zeros(len(positions)), self.planet_radii, strict=True), axis=1)
 
     def _can_move(self, pos):
         """
@@ -112,48 +477,55 @@ class Environment:
 
         return True
 
+    def _can_move_batch(self, positions):
+        """
+        Vectorised `_can_move` for an (N, 3) array of positions. Returns an
+        (N,) boolean mask.
+        """
+        n_dims = 2 if self.zlen == 0 else 3
+        # Positions clipped to an edge are rounded to their own dtype.
+        edges = np.abs(np.array([self.xlen, self.ylen, self.zlen]) / 2)[:n_dims].astype(positions.dtype)
+        on_edge = np.any(positions[:, :n_dims] == edges, axis=1)
+        return ~on_edge & ~self._inside_planet_batch(positions)
+
     def _sanitise_position(self, pos):
         """
         Given a 3D position `pos`, ensures that the position lies witin the
         allowed scope of the environment.
         """
-        return np.clip(pos, 
-                       [-self.xlen / 2, -self.ylen / 2, -self.zlen / 2],
-                       [self.xlen / 2, self.ylen / 2, self.zlen / 2])
-
-    def _check_collision(self, spaceship_idx, t):
-        """
-        Returns None if no collision, otherwise returns tuple (spaceship_idx, type, 
-        idx, pos) where `type` either indicates whether the spaceship has collided 
-        with a Planet, Asteroid or Spaceship, idx represents the index of the 
-        colliding object and pos is the position of the collision.
-        """
-        index = int(t/self.dt)
-        spaceship_pos = self._spaceship_trajectories[spaceship_idx][index]
-        spaceship_radius = self.spaceships[spaceship_idx].radius
-
-        # Asteroid Collision Check
-        for i, asteroid in enumerate(self.asteroids):
-            asteroid_pos = self._asteroid_trajectories[i][index]
-            if spherical_collision(spaceship_pos, asteroid_pos, r1=spaceship_radius, r2=asteroid.radius):
-                return (spaceship_idx, ASTEROID_COLLISION, i, spaceship_pos)
-                
-            
-        # Planetary Collision Check
-        for i, planet in enumerate(self.planets):
-            if spherical_collision(planet, spaceship_pos, r2=spaceship_radius):
-                return (spaceship_idx, PLANET_COLLISION, i, spaceship_pos)
-                
-
-        # Spaceship Collision Check
-        for i, other_spaceship in enumerate(self.spaceships):
-            if i == spaceship_idx:
-                continue
+        return get_backend().sanitise(pos,
+                                      [-self.xlen / 2, -self.ylen / 2, -self.zlen / 2],
+                                      [self.xlen / 2, self.ylen / 2, self.zlen / 2])
+
+    def _check_collision(self, spaceship_idx, index):
+        """
+        Returns None if no collision at time index `index`, otherwise returns
+        tuple (spaceship_idx, type, idx, pos) where `type` either indicates
+        whether the spaceship has collided with a Planet, Asteroid or Spaceship,
+        idx represents the index of the colliding object and pos is the
+        position of the collision.
+        """
+        asteroid_positions = self._asteroid_trajectories.positions_at(index)
+        spaceship_positions = self._spaceship_trajectories.positions_at(index)
+        spaceship_pos = spaceship_positions[spaceship_idx]
+        spaceship_radius = self.spaceship_radii[[spaceship_idx]]
+
+        # Asteroids are checked before planets and planets before other
+        # spaceships, and the first colliding body of each kind is reported.
+        checks = ((ASTEROID_COLLISION, 'asteroid', asteroid_positions, self.asteroid_radii),
+                  (PLANET_COLLISION, 'planet', self.planet_positions, self.planet_radii),
+                  (SPACESHIP_COLLISION, 'spaceship', spaceship_positions, self.spaceship_radii))
+        for collision_type, kind, positions, radii in checks:
+            idx = np.asarray(self._collision_candidates(kind, index, spaceship_pos,
+                                                        spaceship_radius[0] + np.max(radii, initial=0.)), dtype=int)
+            self.instrumentation.count('pair_checks', len(idx))
+            if kind == 'spaceship':
+                idx = idx[idx != spaceship_idx]
+
+            hit = get_backend().first_overlap(spaceship_pos[None], spaceship_radius, positions[idx], radii[idx])[0]
+            if hit != -1:
+                return (spaceship_idx, collision_type, int(idx[hit]), spaceship_pos)
 
-            other_spaceship_pos = self._spaceship_trajectories[i][index]
-            if spherical_collision(spaceship_pos, other_spaceship_pos, r1=spaceship_radius, r2=other_spaceship.radius):
-                return (spaceship_idx, SPACESHIP_COLLISION, i, spaceship_pos)
-        
         return None
 
     def _evaluate_collisions(self):
@@ -162,76 +534,280 @@ class Environment:
         the list is a dictionary describing the two colliding objects and the
         location at which they collided.
         """
-        collisions = []
-        for spaceship_idx, spaceship in enumerate(self.spaceships):
-            for t in np.arange(0., 1., self.dt):
-                res = self._check_collision(spaceship_idx, t)
+        # Time is the outer loop so that the spatial index over the positions
+        # at each time index is built once and shared by all spaceships. Every
+        # recorded step before the horizon is checked, whatever its length.
+        collisions = {}
+        times = self._spaceship_trajectories.times
+        for index in np.flatnonzero(times < self.horizon - TIME_TOLERANCE).tolist():
+            for spaceship_idx in range(len(self.spaceships)):
+                if spaceship_idx in collisions:
+                    continue
+
+                res = self._check_collision(spaceship_idx, index)
                 if res is not None:
-                    collisions.append(res)
-                    break
+                    collisions[spaceship_idx] = res
         
-        return collisions
+        return [collisions[i] for i in sorted(collisions)]
+
+    def _detect_collisions(self, previous=None):
+        """
+        Checks every spaceship which has not yet collided against every
+        asteroid, planet and other spaceship, all pairs at once. Returns the
+        new collisions as a list of tuples in the same format as
+        `_check_collision`, ordered by spaceship index, and records the time
+        of each in `collision_times`.
+
+        Without `previous`, bodies are checked for overlap at their current
+        positions. Otherwise `previous` maps 'asteroid' and 'spaceship' to the
+        positions at the start of the step, bodies are swept linearly from
+        there to their current positions and the reported position and time
+        are those of the first contact during the step. Earlier contacts take
+        precedence, then (as in `_check_collision`) asteroids over planets,
+        planets over spaceships and lower indices over higher ones.
+        """
+        positions = self.spaceship_positions
+        radii = self.spaceship_radii
+        start = positions if previous is None else previous['spaceship']
+        motion = row_norms(positions - start)
+
+        hits = []
+        for kind, collision_type in (('asteroid', ASTEROID_COLLISION),
+                                     ('planet', PLANET_COLLISION),
+                                     ('spaceship', SPACESHIP_COLLISION)):
+            arrays = self._body_arrays(kind)
+            others = arrays.positions
+            others_start = others if previous is None or kind == 'planet' else previous[kind]
+            others_motion = np.max(row_norms(others - others_start), initial=0.)
+
+            # Bodies which touch during the step are at most their combined
+            # motion apart at the end of it.
+            r = radii + np.max(arrays.radii, initial=0.) + motion + others_motion
+            spaceship_idx, idx = self.spaceship_neighbour_pairs(kind, r)
+            if kind == 'spaceship':
+                spaceship_idx, idx = spaceship_idx[spaceship_idx != idx], idx[spaceship_idx != idx]
+
+            self.instrumentation.count('pair_checks', len(spaceship_idx))
+            s = swept_sphere_contact(start[spaceship_idx], positions[spaceship_idx],
+                                     others_start[idx], others[idx],
+                                     radii[spaceship_idx] + arrays.radii[idx])
+            hit = s <= 1
+            hits.append((spaceship_idx[hit], np.full(np.sum(hit), collision_type), idx[hit], s[hit]))
+
+        spaceship_idx, collision_type, idx, s = (np.concatenate(arrays) for arrays in zip(*hits))
+        t0 = self._t if previous is None else self._t - self._last_dt
+
+        found = {}
+        for k in np.lexsort((idx, collision_type, s, spaceship_idx)):
+            i = int(spaceship_idx[k])
+            if i not in found and i not in self._collisions:
+                pos = start[i] + s[k] * (positions[i] - start[i])
+                found[i] = (i, int(collision_type[k]), int(idx[k]), pos)
+                self.collision_times[i] = t0 + s[k] * self._last_dt
+
+        return [found[i] for i in sorted(found)]
     
-    def _step_spaceships(self):
+    def _step_spaceships(self, dt=None):
         """
         Given current state of the environment, increment all of the positions of the
-        spaceships in the environment.
+        spaceships in the environment over a step of length `dt` (by default
+        `self.dt`). A spaceship moves by its navigation vector per `self.dt`.
+
+        If the navigator provides `vector_batch`, the vectors of all spaceships
+        are computed in one call from the current state and applied together.
+        Otherwise spaceships are moved one at a time with `vector`, so later
+        spaceships see the already-updated positions of earlier ones. With
+        adaptive steps, the speed of every spaceship is recorded for
+        `_adaptive_dt`.
         """
+        dt = dt if dt is not None else self.dt
+        instrumentation = self.instrumentation
+        if hasattr(self.navigator, 'vector_batch'):
+            positions = self.spaceship_positions
+            movable = self._can_move_batch(positions)
+            movable[list(self._halted())] = False
+            with instrumentation.phase('navigator'):
+                vectors = self.navigator.vector_batch(self)
+            with instrumentation.phase('sanitise_position'):
+                positions[movable] = self._sanitise_position(positions[movable] + vectors[movable] * (dt / self.dt))
+            self._spaceship_arrays.touch()
+            if self.dt_range is not None:
+                self._speeds = np.where(movable, row_norms(vectors), 0.) / self.dt
+            with instrumentation.phase('trajectory_append'):
+                self._spaceship_trajectories.append(positions, self._t + dt)
+            return
+
+        halted = self._halted()
+        speeds = np.zeros(len(self.spaceships))
         for i, spaceship in enumerate(self.spaceships):
-            if not self._can_move(spaceship.position):
-                self._add_spaceship_pos(i, spaceship.position)
+            if i in halted or not self._can_move(spaceship.position):
                 continue
 
-            new_position = spaceship.position + self.navigator.vector(self, i)
-            spaceship.set_position(self._sanitise_position(new_position))
-            self._add_spaceship_pos(i, spaceship.position)
+            with instrumentation.phase('navigator'):
+                vector = self.navigator.vector(self, i)
+            with instrumentation.phase('sanitise_position'):
+                new_position = self._sanitise_position(spaceship.position + vector * (dt / self.dt))
+            spaceship.set_position(new_position)
+            speeds[i] = np.linalg.norm(vector) / self.dt
+        if self.dt_range is not None:
+            self._speeds = speeds
+
+        with instrumentation.phase('trajectory_append'):
+            self._spaceship_trajectories.append(self.spaceship_positions, self._t + dt)
 
-    def _step_asteroids(self):
+    def _step_asteroids(self, dt=None):
         """
         Given current state of the environment, increment all of the positions of the
-        asteroids in the environment.
+        asteroids in the environment over a step of length `dt` (by default
+        `self.dt`).
         """
-        for i, asteroid in enumerate(self.asteroids):
+        dt = dt if dt is not None else self.dt
+        positions = self.asteroid_positions
+        if dt == self.dt:
+            # Fixed-length steps are read from a table computed ahead, which
+            # is recomputed once used up or if the asteroids were changed.
+            version, table, index = self._asteroid_plan
+            if version != self._asteroid_arrays.version or index == len(table):
+                remaining = int(np.ceil((self.horizon - self._t) / self.dt))
+                table, index = self._precompute_asteroids(min(max(remaining, 1), ASTEROID_PLAN_STEPS)), 0
+            positions[:] = table[index]
+            self._asteroid_arrays.touch()
+            self._asteroid_plan = (self._asteroid_arrays.version, table, index + 1)
+        else:
+            movable = self._can_move_batch(positions)
+            new_positions = positions[movable] + self.asteroid_velocities[movable] * dt
+            with self.instrumentation.phase('sanitise_position'):
+                positions[movable] = self._sanitise_position(new_positions)
+            self._asteroid_arrays.touch()
 
-            if not self._can_move(asteroid.position):
-                self._add_asteroid_pos(i, asteroid.position)
-                continue
+        with self.instrumentation.phase('trajectory_append'):
+            self._asteroid_trajectories.append(positions, self._t + dt)
+
+    def _precompute_asteroids(self, n_steps):
+        """
+        Returns the (n_steps, M, 3) positions of the asteroids after each of
+        the next `n_steps` steps of length `dt`, computed for every step at
+        once rather than one step at a time.
+
+        Until an asteroid stops (see `_can_move`), its position after k steps
+        is its current position plus k increments of velocity * dt, clipped
+        to the environment. The increments are accumulated with a cumulative
+        sum, which adds them in the same order as stepping does, so the
+        positions are identical to stepping. An asteroid which is clipped
+        at a lower wall stays there, as when stepping, and one which reaches
+        an upper wall or enters a planet stops, so its position is held from
+        the first step at which it cannot move.
+        """
+        start = self.asteroid_positions
+        increments = np.broadcast_to(self.asteroid_velocities * self.dt, (n_steps, *start.shape))
+        positions = self._sanitise_position(np.cumsum(np.concatenate([start[None], increments]), axis=0))
+        positions = positions.astype(start.dtype, copy=False)
 
-            new_position = asteroid.position + asteroid.velocity * self.dt
-            asteroid.set_position(self._sanitise_position(new_position))
-            self._add_asteroid_pos(i, asteroid.position)
+        movable = self._can_move_batch(positions.reshape(-1, 3)).reshape(n_steps + 1, len(start))
+        n_moves = np.sum(np.logical_and.accumulate(movable[:-1], axis=0), axis=0)
+        steps = np.minimum(np.arange(1, n_steps + 1)[:, None], n_moves[None, :])
+        return positions[steps, np.arange(len(start))[None, :]]
 
-    def sample_valid_position(self, radius=None):
+    def _adaptive_dt(self):
+        """
+        Returns the length of the next step.
+
+        The spaceships' navigation vectors are only computed once the
+        asteroids have been stepped, as with fixed-length steps, so their
+        speeds are taken to be those of the last step. The first step, for
+        which there are none, is of length `dt_min`.
+
+        A spaceship's clearance is the gap between its surface and the
+        nearest other body's. It may close at most ADAPTIVE_SAFETY of it
+        during the step, given its own speed (the magnitude of its vector)
+        and the speed of the fastest asteroid or spaceship. Nor may it travel
+        further than its goal, or GOAL_TOLERANCE once it is closer than that,
+        so that it does not overshoot. The step is the longest which allows
+        that for every spaceship, within `dt_range`.
+
+        A navigator which keeps its spaceships moving at their goals (e.g.
+        ProposedPotentialFieldNavigator, which always moves 0.1 per `dt`)
+        limits the step to about `dt` once they arrive, so adaptive steps
+        only pay off over a whole run with `early_stop`, which stops
+        stepping spaceships once they arrive.
+        """
+        dt_min, dt_max = self.dt_range
+        positions = self.spaceship_positions
+        if self._speeds is None or len(self._speeds) != len(positions):
+            return dt_min
+
+        radii = self.spaceship_radii
+        speeds = self._speeds.copy()
+        speeds[list(self._halted())] = 0.
+        speeds[~self._can_move_batch(positions)] = 0.
+        asteroid_speed = np.max(row_norms(self.asteroid_velocities), initial=0.)
+        closing_speeds = {'planet': speeds,
+                          'asteroid': speeds + asteroid_speed,
+                          'spaceship': speeds + np.max(speeds, initial=0.)}
+
+        goal_distances = np.maximum(row_norms(self.spaceship_goals - positions), GOAL_TOLERANCE)
+        with np.errstate(divide='ignore'):
+            dt = min(dt_max, np.min(goal_distances / speeds, initial=dt_max))
+
+        for kind, closing in closing_speeds.items():
+            arrays = self._body_arrays(kind)
+            # Bodies further away than this cannot limit the step below dt_max.
+            reach = dt_max * closing / ADAPTIVE_SAFETY
+            spaceship_idx, idx = self.spaceship_neighbour_pairs(kind, radii + np.max(arrays.radii, initial=0.) + reach)
+            if kind == 'spaceship':
+                spaceship_idx, idx = spaceship_idx[spaceship_idx != idx], idx[spaceship_idx != idx]
+
+            clearance = row_norms(positions[spaceship_idx] - arrays.positions[idx]) - radii[spaceship_idx] - arrays.radii[idx]
+            closing = closing[spaceship_idx]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                limits = np.where(closing > 0, ADAPTIVE_SAFETY * np.maximum(clearance, 0.) / closing, np.inf)
+            dt = min(dt, np.min(limits, initial=dt_max))
+
+        return max(dt_min, dt)
+
+    def _sampling_box(self):
+        return ([-self.xlen/2, -self.ylen/2, -self.zlen/2],
+                [self.xlen/2, self.ylen/2, self.zlen/2])
+
+    def _body_spheres(self):
+        """
+        Returns the positions and radii of every body in the environment.
+        """
+        stores = (self._planet_arrays, self._asteroid_arrays, self._spaceship_arrays)
+        return (np.concatenate([arrays.positions for arrays in stores]),
+                np.concatenate([arrays.radii for arrays in stores]))
+
+    def sample_valid_position(self, radius=None, max_attempts=MAX_SAMPLE_ATTEMPTS):
         """
         Return a random position inside the environment which is 
-        not inside an existing object.
+        not inside an existing object. If `radius` is given, a sphere
+        of that radius at the position must not touch any object
+        either. Candidates are drawn and tested in batches (see
+        `sampling.rejection_sample`); raises a RuntimeError if none
+        is valid after `max_attempts` candidates.
+
+        The first candidate is always used if valid. The original sampler
+        discarded its first draw when given a `radius`, so for a given seed
+        positions sampled with a radius (e.g. by `sample_environment`)
+        differ from those it gave.
         """
-        low = [-self.xlen/2, -self.ylen/2, -self.zlen/2]
-        high = [self.xlen/2, self.ylen/2, self.zlen/2]
+        low, high = self._sampling_box()
+        positions, radii = self._body_spheres()
+        return rejection_sample(self.rng, low, high,
+                                lambda candidates: overlapping(candidates, radius or 0., positions, radii),
+                                max_attempts)
 
-        sample = np.random.uniform(low=low, high=high, size=3)
-        if not radius:
-            while self._inside_obj(sample):
-                sample = np.random.uniform(low=low, high=high, size=3)
-        else:
-            obj_collision = True
-            while obj_collision:
-                sample = np.random.uniform(low=low, high=high, size=3)
-                obj_collision = False
-                for planet in self.planets:
-                    if spherical_collision(planet, sample, r2=radius):
-                        obj_collision = True
-                        break
-                for asteroid in self.asteroids:
-                    if spherical_collision(asteroid, sample, r2=radius):
-                        obj_collision = True
-                        break
-                for spaceship in self.spaceships:
-                    if spherical_collision(spaceship, sample, r2=radius):
-                        obj_collision = True
-                        break
-        
-        return sample
+    def sample_packed_positions(self, radii, max_attempts=MAX_SAMPLE_ATTEMPTS):
+        """
+        Returns an (N, 3) array of random positions inside the environment
+        for spheres with the given (N,) `radii`, such that no sphere touches
+        another or an existing object (see `sampling.dart_throwing`). Raises
+        a RuntimeError if a sphere cannot be placed in `max_attempts`
+        candidates.
+        """
+        low, high = self._sampling_box()
+        positions, position_radii = self._body_spheres()
+        return dart_throwing(self.rng, low, high, radii, positions, position_radii, max_attempts)
 
     def sample_valid_radius(self, pos, scale):
         """
@@ -242,55 +818,248 @@ class Environment:
         to be between the objects in the environment, and thus
         indirectly how large the objects are.
         """
-        planet_dists = [euclidean_distance(planet.position, pos) for planet in self.planets]
-        asteroid_dists = [euclidean_distance(asteroid.position, pos) for asteroid in self.asteroids]
-        spaceship_dists = [euclidean_distance(spaceship.position, pos) for spaceship in self.spaceships]
-        dists = [*planet_dists, *asteroid_dists, *spaceship_dists]
-        
-        if not planet_dists and not asteroid_dists and not spaceship_dists:
-            return np.random.uniform(high=self.xlen/4 * scale)
-            
-        min_dist = np.amin(np.array(dists))
+        positions = np.concatenate([self.planet_positions,
+                                    self.asteroid_positions,
+                                    self.spaceship_positions])
+
+        if len(positions) == 0:
+            return self.rng.uniform(high=self.xlen/4 * scale)
+
+        min_dist = np.amin(row_norms(positions - pos))
 
-        return np.random.uniform(high=min_dist * scale)
+        return self.rng.uniform(high=min_dist * scale)
 
     def add_spaceship(self, spaceship):
+        spaceship._bind(self._spaceship_arrays)
         self.spaceships.append(spaceship)
-        self._spaceship_trajectories.append([spaceship.position])
+        self._spaceship_trajectories.add_body(spaceship.position)
 
     def add_asteroid(self, asteroid):
+        asteroid._bind(self._asteroid_arrays)
         self.asteroids.append(asteroid)
-        self._asteroid_trajectories.append([asteroid.position])
+        self._asteroid_trajectories.add_body(asteroid.position)
     
     def add_planet(self, planet):
+        planet._bind(self._planet_arrays)
         self.planets.append(planet)
 
     def state_at_time(self, t) -> Environment:
         """
         Given a time `t`, returns an Environment instance representing the state
-        of the calling environment at time `t`.
-        """
-        shorten = lambda lst, i : lst[:int(i/self.dt)]
-        a_trajectories = shorten(self._asteroid_trajectories, t)
-        s_trajectories = shorten(self._spaceship_trajectories, t)
-        new_env = Environment(self.xlen,
-                           self.ylen,
-                           self.zlen,
-                           self.spaceships,
-                           self.asteroids,
-                           self.planets,
-                           self.dt,
-                           self.navigator)
+        of the calling environment at time `t`. Its trajectories are views of
+        the calling environment's trajectories up to and including `t`; if `t`
+        falls between two steps, they end with the positions interpolated at
+        `t` (see `TrajectoryBuffer.interpolated`).
+        """
+        times = self._spaceship_trajectories.times
+        n_steps = int(np.searchsorted(times, t + TIME_TOLERANCE, side='right'))
+        a_trajectories = self._asteroid_trajectories.truncated(n_steps)
+        s_trajectories = self._spaceship_trajectories.truncated(n_steps)
+        if 0 < n_steps < len(times) and t - times[n_steps - 1] > TIME_TOLERANCE:
+            a_trajectories.append(self._asteroid_trajectories.interpolated(t), t)
+            s_trajectories.append(self._spaceship_trajectories.interpolated(t), t)
+
+        # The new environment shares the body arrays (and so the body views)
+        # of the calling environment rather than re-binding them.
+        new_env = copy.copy(self)
+        new_env._grids = {}
+        new_env._neighbour_lists = {}
+        new_env._collisions = dict(self._collisions)
+        new_env.collision_times = dict(self.collision_times)
+        new_env._frozen = set(self._frozen)
+        new_env.arrival_times = dict(self.arrival_times)
+        new_env.stall_times = dict(self.stall_times)
+        new_env._trajectory_grids = (None, {})
         new_env._asteroid_trajectories = a_trajectories
         new_env._spaceship_trajectories = s_trajectories
         return new_env
 
-    def run(self):
+    def _record_collisions(self, collision_policy, previous=None):
+        """
+        Detects collisions (see `_detect_collisions`) and applies
+        `collision_policy` to them. Returns the new collisions.
+        """
+        new_collisions = self._detect_collisions(previous)
+        for collision in new_collisions:
+            self._collisions[collision[0]] = collision
+            if collision_policy == FREEZE_COLLIDED:
+                self._frozen.add(collision[0])
+
+        return new_collisions
+
+    def _halted(self):
+        """
+        Returns the set of spaceships which are no longer stepped.
+        """
+        return self._frozen | self.arrival_times.keys() | self.stall_times.keys()
+
+    def _record_stops(self, stall_detector=None):
+        """
+        Records the spaceships which have arrived at their goals and, after a
+        step, those which `stall_detector` flags. Returns True once every
+        spaceship is halted.
+        """
+        positions = self.spaceship_positions
+        arrived = row_norms(positions - self.spaceship_goals) < GOAL_TOLERANCE
+        if stall_detector is not None:
+            stalled = stall_detector.update(positions, self._t)
+        else:
+            stalled = np.zeros(len(positions), dtype=bool)
+
+        halted = self._halted()
+        for i in np.flatnonzero(arrived | stalled).tolist():
+            if i not in halted:
+                times = self.arrival_times if arrived[i] else self.stall_times
+                times[i] = self._t
+
+        return len(self._halted()) == len(positions)
 
-        while self._t < 1:
-            self._step_asteroids()
-            self._step_spaceships()
-            self._t += self.dt
+    def _simulate(self, collision_policy, swept, early_stop=False, stall_window=STALL_WINDOW,
+                  stall_distance=STALL_DISTANCE):
+        """
+        Steps the environment until the horizon, or until the first collision
+        with `ABORT_ON_COLLISION`, or with `early_stop` until every spaceship
+        has arrived or stalled. Yields the list of new collisions (always
+        empty if `collision_policy` is None) for the initial state and after
+        every step.
+        """
+        online = collision_policy is not None
+        instrumentation = self.instrumentation
+        # The last adaptive step is shortened to end at the horizon, unless it
+        # only overshoots by rounding, so rounding must not add a vanishingly
+        # short step after it either.
+        end = self.horizon if self.dt_range is None else self.horizon - TIME_TOLERANCE
+        new_collisions = []
+        if online:
+            with instrumentation.phase('detect_collisions'):
+                new_collisions = self._record_collisions(collision_policy)
+        if early_stop:
+            stall_detector = StallDetector(self.spaceship_positions, stall_window, stall_distance, self.dt, self._t)
+            finished = self._record_stops()
+        yield new_collisions
+
+        while self._t < end and not (collision_policy == ABORT_ON_COLLISION and new_collisions):
+            if early_stop and finished:
+                break
+
+            previous = None
+            if swept:
+                previous = {'asteroid': self.asteroid_positions.copy(),
+                            'spaceship': self.spaceship_positions.copy()}
+
+            dt = self.dt
+            if self.dt_range is not None:
+                with instrumentation.phase('adaptive_dt'):
+                    dt = self._adaptive_dt()
+                if self.horizon - self._t < dt - TIME_TOLERANCE:
+                    dt = self.horizon - self._t
+            with instrumentation.phase('step_asteroids'):
+                self._step_asteroids(dt)
+            with instrumentation.phase('step_spaceships'):
+                self._step_spaceships(dt)
+            self._t += dt
+            self._last_dt = dt
+            instrumentation.count('steps')
+
+            if online:
+                with instrumentation.phase('detect_collisions'):
+                    new_collisions = self._record_collisions(collision_policy, previous)
+            if early_stop:
+                with instrumentation.phase('early_stop'):
+                    finished = self._record_stops(stall_detector)
+            yield new_collisions
+
+    def stats(self):
+        """
+        Returns the instrumentation counters of the runs so far as a dict (see
+        `Instrumentation.as_dict`), or None if profiling is disabled.
+        """
+        return self.instrumentation.as_dict()
+
+    def _check_run_options(self, collision_policy, collision_mode):
+        assert collision_policy is None or collision_policy in COLLISION_POLICIES, \
+            f"Unknown collision policy {collision_policy}."
+        assert collision_mode in (DISCRETE_COLLISIONS, SWEPT_COLLISIONS), \
+            f"Unknown collision mode {collision_mode}."
+
+        swept = collision_mode == SWEPT_COLLISIONS
+        if swept and collision_policy is None:
+            collision_policy = RECORD_COLLISIONS
+        return collision_policy, swept
+
+    def run(self, collision_policy=None, collision_mode=DISCRETE_COLLISIONS, early_stop=False,
+            stall_window=STALL_WINDOW, stall_distance=STALL_DISTANCE):
+        """
+        Simulates the environment until `horizon` and returns the spaceship and
+        asteroid trajectories, as (T, N, 3) arrays, along with the list of
+        collisions.
+
+        By default, collisions are evaluated from the trajectories once the
+        simulation has finished. If `collision_policy` is one of
+        `COLLISION_POLICIES`, collisions are instead detected after every
+        step: `RECORD_COLLISIONS` records each spaceship's first collision,
+        `FREEZE_COLLIDED` additionally stops collided spaceships from moving and
+        `ABORT_ON_COLLISION` ends the run as soon as any collision occurs.
+
+        With `collision_mode=SWEPT_COLLISIONS` bodies are treated as moving
+        linearly during each step, so contacts between steps are not missed
+        however large `dt` is; the reported positions and `collision_times`
+        are those of the first contact. Swept detection is always done while
+        stepping, so it implies `RECORD_COLLISIONS` if no policy is given.
+
+        With `early_stop`, spaceships stop being stepped once they arrive at
+        their goals (recorded in `arrival_times`) or stall, i.e. move less
+        than `stall_distance` in `stall_window * dt` of simulated time, which
+        is `stall_window` steps unless steps are adaptive (recorded in
+        `stall_times`), and the run ends as soon as every spaceship has
+        stopped or been frozen. Collisions with asteroids after that point are
+        not simulated.
+        """
+        collision_policy, swept = self._check_run_options(collision_policy, collision_mode)
+        online = collision_policy is not None
+        for _ in self._simulate(collision_policy, swept, early_stop, stall_window, stall_distance):
+            pass
+
+        if not online:
+            with self.instrumentation.phase('evaluate_collisions'):
+                collisions = self._evaluate_collisions()
+        else:
+            collisions = [self._collisions[i] for i in sorted(self._collisions)]
+        return self._spaceship_trajectories.array, self._asteroid_trajectories.array, collisions
+
+    def run_iter(self, collision_policy=RECORD_COLLISIONS, collision_mode=DISCRETE_COLLISIONS, sinks=(),
+                 keep_trajectories=True, early_stop=False, stall_window=STALL_WINDOW,
+                 stall_distance=STALL_DISTANCE):
+        """
+        Generator version of `run`: simulates the environment and yields a
+        `StepState` for the initial state and after every step, so the
+        results can be consumed while the simulation is still running.
+        Collisions are always detected while stepping, with
+        `collision_policy`; the other options are as for `run`.
+
+        Every state is also passed to each of `sinks` (see sinks.py), which
+        are closed once the run ends. If `keep_trajectories` is False, the
+        environment only keeps the latest positions rather than the whole
+        trajectories, so memory use does not grow with the length of the
+        run; the trajectories are then only available through the sinks
+        and `state_at_time` can no longer be used.
+        """
+        assert collision_policy is not None, "run_iter detects collisions while stepping; pass a collision policy."
+        collision_policy, swept = self._check_run_options(collision_policy, collision_mode)
 
-        collisions = self._evaluate_collisions()
-        return self._spaceship_trajectories, self._asteroid_trajectories, collisions
\ No newline at end of file
+        for sink in sinks:
+            sink.open(self)
+        try:
+            for new_collisions in self._simulate(collision_policy, swept, early_stop, stall_window,
+                                                 stall_distance):
+                state = StepState(self._t, self.spaceship_positions.copy(), self.asteroid_positions.copy(),
+                                  new_collisions)
+                for sink in sinks:
+                    sink.write(state)
+                if not keep_trajectories:
+                    self._spaceship_trajectories.discard_history()
+                    self._asteroid_trajectories.discard_history()
+                yield state
+        finally:
+            for sink in sinks:
+                sink.close()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import numpy as np
+
+from components import *
+from math_utils import pairwise_distances, overlap_mask, first_hit
+from trajectories import TrajectoryBuffer
+
+
+def _pad(arrays, tail_shape=(), dtype=np.float64):
+    """
+    Stacks a list of K arrays of shape (n_k, *tail_shape) into a zero-padded
+    (K, max n_k, *tail_shape) array of `dtype`. Also returns the (K, max n_k)
+    mask of the entries which are not padding.
+    """
+    n = max((len(arr) for arr in arrays), default=0)
+    padded = np.zeros((len(arrays), n, *tail_shape), dtype=dtype)
+    mask = np.zeros((len(arrays), n), dtype=bool)
+    for k, arr in enumerate(arrays):
+        padded[k, :len(arr)] = arr
+        mask[k, :len(arr)] = True
+    return padded, mask
+
+
+class Ensemble:
+    """
+    Simulates K independent environments together. The bodies of every
+    environment are packed into zero-padded (K, N, 3) arrays, with (K, N)
+    masks marking which entries are real, and each step advances all of the
+    environments at once, so the per-step Python overhead is paid once
+    rather than K times.
+
+    The environments must share their dimensions, `dt`, `horizon`, `dtype`
+    and type of navigator (the navigator must provide `vector_ensemble`) and
+    must not have been run yet. Bodies and trajectories are stored as their
+    `dtype`, as by an Environment. The ensemble exposes the same array
+    attributes as an Environment (`spaceship_positions`, `planet_radii`,
+    ...), with a leading K dimension, plus `planet_mask`, `asteroid_mask`
+    and `spaceship_mask`.
+    """
+    def __init__(self, envs):
+        assert envs, "An ensemble needs at least one environment."
+        first = envs[0]
+        for env in envs:
+            assert (env.xlen, env.ylen, env.zlen, env.dt, env.horizon) == \
+                (first.xlen, first.ylen, first.zlen, first.dt, first.horizon), \
+                "Every environment in an ensemble must have the same dimensions, dt and horizon."
+            assert type(env.navigator) is type(first.navigator), \
+                "Every environment in an ensemble must use the same type of navigator."
+            assert len(env._spaceship_trajectories) == 1, \
+                "Environments must not have been run before being added to an ensemble."
+            assert env.dt_range is None, "Ensembles do not support adaptive steps."
+            assert env.dtype == first.dtype, "Every environment in an ensemble must have the same dtype."
+
+        self.envs = envs
+        self.xlen, self.ylen, self.zlen = first.xlen, first.ylen, first.zlen
+        self.dt = first.dt
+        self.horizon = first.horizon
+        self.navigator = first.navigator
+        self.rng = first.rng
+        self.dtype = first.dtype
+
+        self.planet_positions, self.planet_mask = _pad([env.planet_positions for env in envs], (3,), self.dtype)
+        self.planet_radii, _ = _pad([env.planet_radii for env in envs], (), self.dtype)
+        self.asteroid_positions, self.asteroid_mask = _pad([env.asteroid_positions for env in envs], (3,), self.dtype)
+        self.asteroid_radii, _ = _pad([env.asteroid_radii for env in envs], (), self.dtype)
+        self.asteroid_velocities, _ = _pad([env.asteroid_velocities for env in envs], (3,), self.dtype)
+        self.spaceship_positions, self.spaceship_mask = _pad([env.spaceship_positions for env in envs], (3,), self.dtype)
+        self.spaceship_radii, _ = _pad([env.spaceship_radii for env in envs], (), self.dtype)
+        self.spaceship_goals, _ = _pad([env.spaceship_goals for env in envs], (3,), self.dtype)
+
+    def __len__(self):
+        return len(self.envs)
+
+    def _can_move(self, positions):
+        """
+        Ensemble version of `Environment._can_move_batch` for (K, N, 3)
+        positions.
+        """
+        n_dims = 2 if self.zlen == 0 else 3
+        # Positions clipped to an edge are rounded to their own dtype.
+        edges = np.abs(np.array([self.xlen, self.ylen, self.zlen]) / 2)[:n_dims].astype(positions.dtype)
+        on_edge = np.any(positions[..., :n_dims] == edges, axis=-1)
+
+        dist = pairwise_distances(positions, self.planet_positions)
+        inside = overlap_mask(dist, np.zeros(positions.shape[:2]), self.planet_radii, strict=True)
+        inside = np.any(inside & self.planet_mask[:, None, :], axis=-1)
+        return ~on_edge & ~inside
+
+    def _sanitise_position(self, pos):
+        return self.envs[0]._sanitise_position(pos)
+
+    def _step_asteroids(self, active):
+        positions = self.asteroid_positions
+        movable = self._can_move(positions) & self.asteroid_mask & active[:, None]
+        new_positions = positions[movable] + self.asteroid_velocities[movable] * self.dt
+        positions[movable] = self._sanitise_position(new_positions)
+
+    def _step_spaceships(self, active, frozen):
+        positions = self.spaceship_positions
+        movable = self._can_move(positions) & self.spaceship_mask & active[:, None] & ~frozen
+        vectors = self.navigator.vector_ensemble(self)
+        positions[movable] = self._sanitise_position(positions[movable] + vectors[movable])
+
+    def _detect_collisions(self, candidates):
+        """
+        Ensemble version of `Environment._detect_collisions` (without
+        sweeping). Returns the (K, N) collision type and index of the
+        colliding body for the spaceships in the (K, N) mask `candidates`,
+        with -1 where there is no collision.
+        """
+        positions = self.spaceship_positions
+        radii = self.spaceship_radii
+        collision_type = np.full(candidates.shape, -1)
+        collision_idx = np.full(candidates.shape, -1)
+
+        for kind, others, others_radii, others_mask in (
+                (ASTEROID_COLLISION, self.asteroid_positions, self.asteroid_radii, self.asteroid_mask),
+                (PLANET_COLLISION, self.planet_positions, self.planet_radii, self.planet_mask),
+                (SPACESHIP_COLLISION, positions, radii, self.spaceship_mask)):
+            dist = pairwise_distances(positions, others)
+            hit = overlap_mask(dist, radii, others_radii) & others_mask[:, None, :]
+            if kind == SPACESHIP_COLLISION:
+                hit &= ~np.eye(hit.shape[1], dtype=bool)[None, :, :]
+
+            idx = first_hit(hit)
+            new = (idx != -1) & candidates & (collision_type == -1)
+            collision_type[new] = kind
+            collision_idx[new] = idx[new]
+
+        return collision_type, collision_idx
+
+    def run(self, collision_policy=RECORD_COLLISIONS):
+        """
+        Simulates every environment until the horizon, detecting collisions after
+        every step according to `collision_policy` (see `Environment.run`;
+        with `ABORT_ON_COLLISION` only the environment with the collision
+        stops). Returns a list with the result of `Environment.run` for each
+        environment.
+
+        The final state is also written back into each Environment, so that
+        afterwards they look as if they had been run individually (e.g.
+        `Spaceship.at_goal` reflects the end of the simulation).
+        """
+        assert collision_policy in COLLISION_POLICIES, f"Unknown collision policy {collision_policy}."
+
+        n_envs = len(self.envs)
+        capacity = int(np.ceil(self.horizon / self.dt)) + 2
+        spaceship_trajectories = np.empty((capacity, *self.spaceship_positions.shape), dtype=self.dtype)
+        asteroid_trajectories = np.empty((capacity, *self.asteroid_positions.shape), dtype=self.dtype)
+        times = np.zeros((capacity, n_envs))
+        spaceship_trajectories[0] = self.spaceship_positions
+        asteroid_trajectories[0] = self.asteroid_positions
+
+        t = np.zeros(n_envs)
+        n_steps = np.ones(n_envs, dtype=int)
+        active = np.ones(n_envs, dtype=bool)
+        frozen = np.zeros(self.spaceship_mask.shape, dtype=bool)
+        collisions = [{} for _ in range(n_envs)]
+        collision_times = [{} for _ in range(n_envs)]
+
+        def record_collisions():
+            candidates = self.spaceship_mask & active[:, None]
+            for k in range(n_envs):
+                candidates[k, list(collisions[k])] = False
+
+            collision_type, collision_idx = self._detect_collisions(candidates)
+            for k, i in zip(*np.nonzero(collision_type >= 0)):
+                i = int(i)
+                collisions[k][i] = (i, int(collision_type[k, i]), int(collision_idx[k, i]),
+                                    self.spaceship_positions[k, i].copy())
+                collision_times[k][i] = t[k]
+
+            if collision_policy == FREEZE_COLLIDED:
+                frozen[collision_type >= 0] = True
+            elif collision_policy == ABORT_ON_COLLISION:
+                active[np.any(collision_type >= 0, axis=1)] = False
+
+        record_collisions()
+        step = 0
+        while np.any(active & (t < self.horizon)):
+            active &= t < self.horizon
+            self._step_asteroids(active)
+            self._step_spaceships(active, frozen)
+            t[active] += self.dt
+            n_steps[active] += 1
+
+            step += 1
+            spaceship_trajectories[step] = self.spaceship_positions
+            asteroid_trajectories[step] = self.asteroid_positions
+            times[step] = t
+            record_collisions()
+
+        results = []
+        for k, env in enumerate(self.envs):
+            n_spaceships, n_asteroids = len(env.spaceships), len(env.asteroids)
+            env.spaceship_positions[:] = self.spaceship_positions[k, :n_spaceships]
+            env.asteroid_positions[:] = self.asteroid_positions[k, :n_asteroids]
+            env._spaceship_arrays.touch()
+            env._asteroid_arrays.touch()
+
+            # An environment which stopped early kept its last positions in
+            # the later rows, so its first n_steps rows are its trajectory.
+            env._spaceship_trajectories = TrajectoryBuffer.from_array(
+                spaceship_trajectories[:n_steps[k], k, :n_spaceships], times=times[:n_steps[k], k], dtype=env.dtype)
+            env._asteroid_trajectories = TrajectoryBuffer.from_array(
+                asteroid_trajectories[:n_steps[k], k, :n_asteroids], times=times[:n_steps[k], k], dtype=env.dtype)
+            env._t = t[k]
+            env._collisions = collisions[k]
+            env.collision_times = collision_times[k]
+            if collision_policy == FREEZE_COLLIDED:
+                env._frozen = set(collisions[k])
+
+            results.append((env._spaceship_trajectories.array,
+                            env._asteroid_trajectories.array,
+                            [collisions[k][i] for i in sorted(collisions[k])]))
+
+        return results
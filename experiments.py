@@ -1,8 +1,15 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import numpy as np
 
+from backends import get_backend, set_backend
 from components import *
+from ensemble import Ensemble
+from instrumentation import Instrumentation, merge_stats
 from potential_field_navigator import *
-from math_utils import normalise
+from math_utils import normalise, row_norms
 
 
 ASTEROID_SCALE = 0.1
@@ -10,8 +17,30 @@ PLANET_SCALE = 0.25
 SPACESHIP_SCALE = 0.05
 
 
-def sample_environment(xlen, ylen, zlen, n_planets, n_asteroids, n_spaceships, spaceship_radius, dt, navigator, asteroid_radius=None, planet_radius=None):
-    env = Environment(xlen, ylen, zlen, [], [], [], dt, navigator)
+def sample_environment(xlen, ylen, zlen, n_planets, n_asteroids, n_spaceships, spaceship_radius, dt, navigator, asteroid_radius=None, planet_radius=None, cell_size=None, rng=None, packed=False, horizon=1., dt_range=None, instrumentation=None, neighbour_skin=None, dtype=np.float64):
+    """
+    Samples an environment with the given numbers of bodies at random
+    positions. If `packed` is set, each kind of body (and the spaceships'
+    goals) is placed at once by `Environment.sample_packed_positions`
+    rather than one body at a time, which is much faster for crowded
+    environments.
+    """
+    env = Environment(xlen, ylen, zlen, [], [], [], dt, navigator, cell_size=cell_size, rng=rng, horizon=horizon,
+                      dt_range=dt_range, instrumentation=instrumentation, neighbour_skin=neighbour_skin, dtype=dtype)
+
+    if packed:
+        planet_r = planet_radius if planet_radius is not None else 2.
+        asteroid_r = asteroid_radius if asteroid_radius is not None else 0.75
+        for pos in env.sample_packed_positions(np.full(n_planets, planet_r)):
+            env.add_planet(Planet(pos, planet_r))
+        for pos in env.sample_packed_positions(np.full(n_asteroids, asteroid_r)):
+            vel = normalise(env.rng.uniform(size=3))
+            env.add_asteroid(Asteroid(pos, asteroid_r, vel))
+        goals = env.sample_packed_positions(np.full(n_spaceships, spaceship_radius))
+        positions = env.sample_packed_positions(np.full(n_spaceships, spaceship_radius))
+        for pos, goal in zip(positions, goals):
+            env.add_spaceship(Spaceship(pos, spaceship_radius, goal))
+        return env
 
     for _ in range(n_planets):
         r = planet_radius if planet_radius is not None else 2.
@@ -22,7 +51,7 @@ def sample_environment(xlen, ylen, zlen, n_planets, n_asteroids, n_spaceships, s
     for _ in range(n_asteroids):
         r = asteroid_radius if asteroid_radius is not None else 0.75
         pos = env.sample_valid_position(radius=r)
-        vel = normalise(np.random.uniform(size=3))
+        vel = normalise(env.rng.uniform(size=3))
         env.add_asteroid(Asteroid(pos, r, vel))
         # print(f'New Asteroid: Position {pos} with Radius {r}.')
     
@@ -33,29 +62,164 @@ def sample_environment(xlen, ylen, zlen, n_planets, n_asteroids, n_spaceships, s
         # print(f'New Spaceship: Position {pos} with Radius {r}.')
 
     return env
+
+
+def sample_environment_from_config(config, rng=None):
+    return sample_environment(config['xlen'], 
+                              config['ylen'],
+                              config['zlen'], 
+                              config['n_planets'], 
+                              config['n_asteroids'],
+                              config['n_spaceships'],
+                              config['spaceship_radius'],
+                              config['dt'],
+                              config['navigator'],
+                              asteroid_radius=config['asteroid_radius'],
+                              planet_radius=config['planet_radius'],
+                              cell_size=config.get('cell_size'),
+                              rng=rng,
+                              packed=bool(config.get('packed')),
+                              horizon=config.get('horizon', 1.),
+                              dt_range=config.get('dt_range'),
+                              instrumentation=Instrumentation() if config.get('instrument') else None,
+                              neighbour_skin=config.get('neighbour_skin'),
+                              dtype=config.get('dtype', np.float64))
+
+
+def _run_environment(config, env):
+    """
+    Runs `env` with the run options in `config` and returns its collisions.
+    """
+    _, _, collisions = env.run(collision_policy=config.get('collision_policy'),
+                               early_stop=bool(config.get('early_stop')),
+                               stall_window=config.get('stall_window', STALL_WINDOW),
+                               stall_distance=config.get('stall_distance', STALL_DISTANCE))
+    return collisions
+
+
+def run_environments(config, rngs):
+    """
+    Samples one environment per entry of `rngs` (a numpy.random.Generator, or
+    None to use the global numpy state) and runs them, yielding each
+    environment together with its list of collisions. If `config['ensemble']`
+    is set, all of the environments are simulated together as an Ensemble.
+    If `config['early_stop']` is set, runs end once every spaceship has
+    arrived or stalled (see `Environment.run`), with the config's
+    'stall_window' and 'stall_distance' if given; this is not supported by
+    ensembles.
+    """
+    if not config.get('ensemble'):
+        for rng in rngs:
+            env = sample_environment_from_config(config, rng=rng)
+            yield env, _run_environment(config, env)
+        return
+
+    assert not config.get('early_stop'), "Ensembles do not support early stopping."
+
+    envs = [sample_environment_from_config(config, rng=rng) for rng in rngs]
+    results = Ensemble(envs).run(collision_policy=config.get('collision_policy') or RECORD_COLLISIONS)
+    for env, (_, _, collisions) in zip(envs, results):
+        yield env, collisions
+
+
+def _outcome(env, collisions):
+    """
+    Returns the outcome of a run of `env`: its list of collisions, whether
+    every spaceship reached its goal, whether any spaceship stalled and its
+    instrumentation counters (see `Environment.stats`).
+    """
+    return (collisions, all(spaceship.at_goal() for spaceship in env.spaceships), bool(env.stall_times),
+            env.stats())
+
+
+def _run_outcomes(config, seeds):
+    """
+    Runs one environment per entry of `seeds` (a numpy.random.SeedSequence,
+    or None to use the global numpy state) and returns the `_outcome` of
+    each. This is the unit of work handed to each worker process.
+    """
+    rngs = [np.random.default_rng(seed) if seed is not None else None for seed in seeds]
+    return [_outcome(env, collisions) for env, collisions in run_environments(config, rngs)]
+
+
+def _run_chunk(run_chunk, config, seeds):
+    # The backend is global, so it is put back afterwards in case the runs
+    # are made in the calling process.
+    previous = get_backend().name
+    if config.get('backend'):
+        set_backend(config['backend'])
+    try:
+        return run_chunk(config, seeds)
+    finally:
+        set_backend(previous)
+
+
+def _map_runs(run_chunk, config):
+    """
+    Calls `run_chunk(config, seeds)`, which returns one result per seed, for
+    `config['n_runs']` runs and returns the results in run order. The runs
+    are split between `config['n_workers']` processes and seeded as
+    described in `collision_rate_experiment`, and use the kernel backend
+    `config['backend']` (see `backends.set_backend`) if it is set.
+    """
+    n_runs = config['n_runs']
+    n_workers = config.get('n_workers') or 1
+    if config.get('seed') is None and n_workers == 1:
+        seeds = [None] * n_runs
+    else:
+        seeds = np.random.SeedSequence(config.get('seed')).spawn(n_runs)
+
+    # No more workers than runs, so that every worker gets at least one.
+    n_workers = max(1, min(n_workers, n_runs))
+    if n_workers == 1:
+        return _run_chunk(run_chunk, config, seeds)
+
+    chunks = [seeds[i::n_workers] for i in range(n_workers)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        chunk_results = list(executor.map(_run_chunk, repeat(run_chunk), repeat(config), chunks))
+    return [chunk_results[i % n_workers][i // n_workers] for i in range(n_runs)]
     
         
 def collision_rate_experiment(config):
     """
     Returns the rate of collisions between spaceships and other
     obstacles the for the total number of runs in the environment.
+
+    If `config` has a 'collision_policy' it is passed to `Environment.run`.
+    With `ABORT_ON_COLLISION` each failing run stops at its first collision,
+    so only the collisions at that step are counted in the per-type rates.
+    If `config['ensemble']` is set the runs are simulated together (see
+    `run_environments`).
+
+    If `config['seed']` is set, every run samples from its own
+    numpy.random.Generator derived from that seed, so the results are
+    reproducible. If `config['n_workers']` is more than one, the runs are
+    split between that many worker processes; each run still gets the same
+    Generator, so the results do not depend on the number of workers.
+
+    With `config['early_stop']` (see `run_environments`), 'minima' is the
+    rate of runs without collisions in which a spaceship stalled, as flagged
+    by the stall detector. Otherwise it is inferred from the failures which
+    were not collisions.
+
+    If `config['instrument']` is set, every run is profiled (see
+    `instrumentation.Instrumentation`) and the result has a 'stats' entry
+    with the phase times, call counts and counters summed over the runs.
+    Ensembles are not profiled.
+    """
+    return summarise_outcomes(config, _map_runs(_run_outcomes, config))
+
+
+def summarise_outcomes(config, outcomes):
+    """
+    Returns the rates reported by `collision_rate_experiment` for a list of
+    run `_outcome`s.
     """
     success, fail = 0, 0
     a_collisions, s_collisions, p_collisions = 0, 0, 0
+    minima = 0
 
-    for run in range(config['n_runs']):
-        env = sample_environment(config['xlen'], 
-                                 config['ylen'],
-                                 config['zlen'], 
-                                 config['n_planets'], 
-                                 config['n_asteroids'],
-                                 config['n_spaceships'],
-                                 config['spaceship_radius'],
-                                 config['dt'],
-                                 config['navigator'],
-                                 asteroid_radius=config['asteroid_radius'],
-                                 planet_radius=config['planet_radius'])
-        _, _, collisions = env.run()
+    for collisions, reached_goals, stalled, _ in outcomes:
         
         # We can fail because there was a collision
         if collisions:
@@ -69,27 +233,203 @@ def collision_rate_experiment(config):
                     s_collisions += 1
             fail += 1
         # ... or not all of the spaceships reached their destination
+        elif not reached_goals:
+            fail += 1
+            minima += stalled
+
+        # All spaceships made it successfully
         else:
-            single_fail = False
-            for spaceship in env.spaceships:
-                if not spaceship.at_goal():
-                    fail += 1
-                    single_fail = True
-                    break
-
-            # All spaceships made it successfully
-            if not single_fail:
-                success += 1
-
-                # # Calculate how long it took for the experiment
-                # # to become successful
-                # for spaceship in env.spacehips:
+            success += 1
+
+            # # Calculate how long it took for the experiment
+            # # to become successful
+            # for spaceship in env.spacehips:
     
+    if not config.get('early_stop'):
+        minima = fail - a_collisions - s_collisions - p_collisions
+
+    n_runs = len(outcomes)
+    result = {
+        'success': success/n_runs,
+        'fail': fail/n_runs,
+        'asteroid': a_collisions/n_runs,
+        'spaceship': s_collisions/n_runs,
+        'planet': p_collisions/n_runs,
+        'minima': minima/n_runs
+    }
+    if config.get('instrument'):
+        result['stats'] = merge_stats([stats for *_, stats in outcomes])
+    return result
+
+
+def _clone_scenario(env, navigator, config, asteroid_table=None, dtype=None):
+    """
+    Returns a copy of the freshly sampled `env` with its own bodies, random
+    state and `navigator`, stored as `dtype` if given. If `asteroid_table`
+    (see `Environment._precompute_asteroids`) is given, the copy reads its
+    asteroid positions from it rather than computing them again.
+    """
+    clone = Environment(env.xlen, env.ylen, env.zlen,
+                        [Spaceship(s.position.copy(), s.radius, s.goal.copy()) for s in env.spaceships],
+                        [Asteroid(a.position.copy(), a.radius, a.velocity.copy()) for a in env.asteroids],
+                        [Planet(p.position.copy(), p.radius) for p in env.planets],
+                        env.dt, navigator, cell_size=env.cell_size,
+                        rng=copy.deepcopy(env.rng) if env.rng is not np.random else None,
+                        horizon=env.horizon, dt_range=env.dt_range,
+                        instrumentation=Instrumentation() if config.get('instrument') else None,
+                        neighbour_skin=env.neighbour_skin, dtype=dtype if dtype is not None else env.dtype)
+    if asteroid_table is not None:
+        clone._asteroid_plan = (clone._asteroid_arrays.version, asteroid_table, 0)
+    return clone
+
+
+def _compare_outcomes(config, seeds):
+    """
+    Samples one scenario per entry of `seeds` (as `_run_outcomes` does) and
+    runs each of the navigators in `config['navigators']` on a copy of it,
+    returning a dict of navigator name to `_outcome` per scenario.
+    """
+    results = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed) if seed is not None else None
+        scenario = sample_environment_from_config({**config, 'navigator': None}, rng=rng)
+
+        # The asteroids do not depend on the navigator, so with fixed-length
+        # steps their positions are computed once for the whole horizon (one
+        # extra step covers rounding in the simulated time).
+        table = None
+        if scenario.dt_range is None:
+            table = scenario._precompute_asteroids(int(np.ceil(scenario.horizon / scenario.dt)) + 1)
+
+        outcomes = {}
+        for name, navigator in config['navigators'].items():
+            env = _clone_scenario(scenario, navigator, config, table)
+            outcomes[name] = _outcome(env, _run_environment(config, env))
+        results.append(outcomes)
+    return results
+
+
+def _succeeded(outcome):
+    collisions, reached_goals, _, _ = outcome
+    return not collisions and reached_goals
+
+
+def compare_navigators(config, navigators):
+    """
+    Runs every navigator in `navigators` (a dict of name to navigator, or a
+    list of navigators named after their classes) on the same
+    `config['n_runs']` sampled scenarios, so that their results differ only
+    because of the navigators. Each scenario is sampled once and every
+    navigator runs on its own copy of it, with the same random state, and
+    the asteroid trajectories are only computed once per scenario. The
+    config's 'navigator' is ignored; the other keys are as for
+    `collision_rate_experiment`, except that ensembles are not supported.
+
+    Returns a dict with
+        'summary':  navigator name to its `collision_rate_experiment` result
+        'outcomes': one dict per scenario of navigator name to
+                    {'success', 'reached', 'stalled', 'collisions'}, where
+                    'collisions' is the list of collision types
+        'paired':   for each pair of navigators 'A vs B', the number of
+                    scenarios in which only A succeeded ('a_only'), only B
+                    did ('b_only'), both did ('both') or neither did
+                    ('neither'), e.g. for McNemar's test
+    """
+    assert not config.get('ensemble'), "Comparisons do not support ensembles."
+    if not isinstance(navigators, dict):
+        navigators = {type(navigator).__name__: navigator for navigator in navigators}
+    names = list(navigators)
+    outcomes = _map_runs(_compare_outcomes, {**config, 'navigator': None, 'navigators': navigators})
+
+    summary = {name: summarise_outcomes(config, [scenario[name] for scenario in outcomes]) for name in names}
+    per_scenario = [{name: {'success': _succeeded(outcome),
+                            'reached': outcome[1],
+                            'stalled': outcome[2],
+                            'collisions': [collision[1] for collision in outcome[0]]}
+                     for name, outcome in scenario.items()}
+                    for scenario in outcomes]
+
+    paired = {}
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            counts = {'a_only': 0, 'b_only': 0, 'both': 0, 'neither': 0}
+            for scenario in per_scenario:
+                a_success, b_success = scenario[a]['success'], scenario[b]['success']
+                key = 'both' if a_success and b_success else 'a_only' if a_success else \
+                      'b_only' if b_success else 'neither'
+                counts[key] += 1
+            paired[f'{a} vs {b}'] = counts
+
+    return {'summary': summary, 'outcomes': per_scenario, 'paired': paired}
+
+
+def _precision_outcomes(config, seeds):
+    """
+    Samples one scenario per entry of `seeds` (as `_run_outcomes` does) and
+    runs `config['navigator']` on a float64 copy of it and on a copy stored
+    as `config['dtype']`, returning a dict comparing the two runs per
+    scenario.
+    """
+    results = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed) if seed is not None else None
+        scenario = sample_environment_from_config({**config, 'dtype': np.float64}, rng=rng)
+        reference = _clone_scenario(scenario, config['navigator'], config)
+        reduced = _clone_scenario(scenario, config['navigator'], config, dtype=config['dtype'])
+        reference_collisions = _run_environment(config, reference)
+        reduced_collisions = _run_environment(config, reduced)
+
+        divergence = {}
+        for kind in ('spaceship', 'asteroid'):
+            a = getattr(reference, f'_{kind}_trajectories').array
+            b = getattr(reduced, f'_{kind}_trajectories').array
+            n_steps = min(len(a), len(b))
+            divergence[kind] = row_norms(b[:n_steps] - a[:n_steps])
+
+        collided = lambda collisions: {(i, type, idx) for i, type, idx, _ in collisions}
+        bytes_per_sample = lambda env: sum(trajectories.array[0].nbytes for trajectories in
+                                           (env._spaceship_trajectories, env._asteroid_trajectories))
+        results.append({
+            'max_spaceship_divergence': float(np.max(divergence['spaceship'], initial=0.)),
+            'final_spaceship_divergence': float(np.max(divergence['spaceship'][-1], initial=0.)),
+            'max_asteroid_divergence': float(np.max(divergence['asteroid'], initial=0.)),
+            'collisions_match': collided(reference_collisions) == collided(reduced_collisions),
+            'goals_match': ([s.at_goal() for s in reference.spaceships] ==
+                            [s.at_goal() for s in reduced.spaceships]),
+            'bytes_per_sample': (bytes_per_sample(reference), bytes_per_sample(reduced)),
+        })
+    return results
+
+
+def precision_experiment(config, dtype=np.float32):
+    """
+    Measures how far runs stored as `dtype` (see `Environment.dtype`) diverge
+    from float64 runs of the same `config['n_runs']` scenarios, which are
+    sampled and seeded as in `collision_rate_experiment`. Returns a dict
+    with
+        'max_spaceship_divergence':  the largest distance between a
+                                     spaceship's positions in the two runs
+        'mean_final_divergence':     the largest such distance at the end
+                                     of a run, averaged over the runs
+        'max_asteroid_divergence':   as 'max_spaceship_divergence'
+        'collision_mismatch_rate':   the fraction of runs whose collisions
+                                     (spaceship, type and body) differ
+        'goal_mismatch_rate':        the fraction of runs in which a
+                                     different set of spaceships reached
+                                     their goals
+        'bytes_per_sample':          the trajectory memory per time step
+                                     of a run, in float64 and in `dtype`
+        'outcomes':                  the above for each run
+    """
+    assert config['n_runs'] > 0, "A precision experiment needs at least one run."
+    outcomes = _map_runs(_precision_outcomes, {**config, 'dtype': dtype})
+    reference_bytes, reduced_bytes = outcomes[0]['bytes_per_sample']
     return {
-        'success': success/config['n_runs'],
-        'fail': fail/config['n_runs'],
-        'asteroid': a_collisions/config['n_runs'],
-        'spaceship': s_collisions/config['n_runs'],
-        'planet': p_collisions/config['n_runs'],
-        'minima':(fail - a_collisions - s_collisions - p_collisions)/config['n_runs']
+        'max_spaceship_divergence': max(o['max_spaceship_divergence'] for o in outcomes),
+        'mean_final_divergence': float(np.mean([o['final_spaceship_divergence'] for o in outcomes])),
+        'max_asteroid_divergence': max(o['max_asteroid_divergence'] for o in outcomes),
+        'collision_mismatch_rate': float(np.mean([not o['collisions_match'] for o in outcomes])),
+        'goal_mismatch_rate': float(np.mean([not o['goals_match'] for o in outcomes])),
+        'bytes_per_sample': {'float64': reference_bytes, np.dtype(dtype).name: reduced_bytes},
+        'outcomes': outcomes,
     }
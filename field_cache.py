@@ -0,0 +1,51 @@
+import itertools
+
+import numpy as np
+
+
+# Number of grid points at which the field is evaluated at once when a
+# GridField is built.
+SAMPLE_CHUNK_SIZE = 4096
+
+
+class GridField:
+    """
+    A vector field sampled once on a regular grid over the box
+    [`lows`, `highs`] and looked up at arbitrary points by trilinear
+    interpolation, so each lookup costs the same however expensive the field
+    is to evaluate. The grid has `resolution` samples along each axis, or a
+    single one along axes with no extent (e.g. z in a 2D environment).
+    `field` maps a (P, 3) array of points to the (P, 3) field at them.
+    Points outside the box get the value at the nearest point on its
+    boundary.
+    """
+    def __init__(self, lows, highs, resolution, field):
+        self.lows = np.asarray(lows, dtype=float)
+        self.highs = np.asarray(highs, dtype=float)
+        self.shape = np.array([resolution if hi > lo else 1 for lo, hi in zip(self.lows, self.highs)])
+
+        axes = [np.linspace(lo, hi, n) for lo, hi, n in zip(self.lows, self.highs, self.shape)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        values = np.empty_like(grid)
+        for start in range(0, len(grid), SAMPLE_CHUNK_SIZE):
+            values[start:start + SAMPLE_CHUNK_SIZE] = field(grid[start:start + SAMPLE_CHUNK_SIZE])
+        self.values = values.reshape(*self.shape, 3)
+
+    def lookup(self, points):
+        """
+        Returns the (P, 3) interpolated field at the (P, 3) array `points`.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        extent = np.where(self.highs > self.lows, self.highs - self.lows, 1.)
+        u = np.clip((points - self.lows) / extent * (self.shape - 1), 0, self.shape - 1)
+
+        i0 = np.minimum(np.floor(u).astype(int), np.maximum(self.shape - 2, 0))
+        i1 = np.minimum(i0 + 1, self.shape - 1)
+        frac = u - i0
+
+        result = np.zeros_like(points)
+        for corner in itertools.product((False, True), repeat=3):
+            idx = np.where(corner, i1, i0)
+            weight = np.prod(np.where(corner, frac, 1 - frac), axis=-1)
+            result += weight[:, None] * self.values[idx[:, 0], idx[:, 1], idx[:, 2]]
+        return result
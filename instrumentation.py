@@ -0,0 +1,98 @@
+import time
+from collections import defaultdict
+
+
+class _Phase:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        for hook in self.instrumentation.hooks:
+            hook('enter', self.name, None)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        instrumentation = self.instrumentation
+        instrumentation.times[self.name] += elapsed
+        instrumentation.calls[self.name] += 1
+        for hook in instrumentation.hooks:
+            hook('exit', self.name, elapsed)
+
+
+class _NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Instrumentation:
+    """
+    Opt-in profiling for an Environment: the wall time spent in, and the
+    number of calls to, each phase of a run (e.g. 'navigator',
+    'step_asteroids', 'detect_collisions'), plus named counters (e.g.
+    'pair_checks', the number of body pairs tested for collisions). Phases
+    can nest (e.g. 'navigator' within 'step_spaceships'), and the time of a
+    phase includes that of the phases nested in it.
+
+    Callables in `hooks` are called as `hook('enter', phase, None)` when a
+    phase starts and `hook('exit', phase, elapsed)` when it ends, so external
+    profilers can attach to the same phases.
+    """
+    def __init__(self, hooks=()):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.hooks = list(hooks)
+
+    def phase(self, name):
+        """
+        Returns a context manager which times its body as the phase `name`.
+        """
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def as_dict(self):
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+
+class NullInstrumentation:
+    """
+    The instrumentation of an Environment with profiling disabled: phases and
+    counters are no-ops, so the cost is one method call per phase.
+    """
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+    def as_dict(self):
+        return None
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def merge_stats(stats):
+    """
+    Sums a list of `Instrumentation.as_dict` results (ignoring None) into one
+    dict of the same form, or returns None if there are none.
+    """
+    stats = [s for s in stats if s is not None]
+    if not stats:
+        return None
+
+    merged = {'times': defaultdict(float), 'calls': defaultdict(int), 'counters': defaultdict(int)}
+    for s in stats:
+        for kind, values in s.items():
+            for name, value in values.items():
+                merged[kind][name] += value
+    return {kind: dict(values) for kind, values in merged.items()}
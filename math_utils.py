@@ -61,4 +61,129 @@ def spherical_collision(sphere1, sphere2, r1=None, r2=None):
         radius2 = sphere2.radius
         
     dist = euclidean_distance(pos1, pos2)
-    return (dist <= radius1 + radius2)
\ No newline at end of file
+    return (dist <= radius1 + radius2)
+
+
+def displacements(a, b, out=None):
+    """
+    Returns the (..., N, M, 3) displacements `a - b` between every row of `a`
+    (..., N, 3) and every row of `b` (..., M, 3). Any leading dimensions are
+    broadcast.
+    """
+    return np.subtract(a[..., :, None, :], b[..., None, :, :], out=out)
+
+
+def row_norms(v, out=None, work=None):
+    """
+    Returns the Euclidean norms of the rows (along the last axis) of `v`. The
+    squares are written to `work`, which may be `v` itself if it is not
+    needed afterwards, and the norms to `out`, so nothing is allocated if
+    both are given.
+    """
+    work = np.square(v, out=work)
+    if out is None:
+        return np.sqrt(np.sum(work, axis=-1))
+    np.sum(work, axis=-1, out=out)
+    return np.sqrt(out, out=out)
+
+
+def pairwise_distances(a, b, out=None, work=None):
+    """
+    Returns the (..., N, M) distances between every row of `a` (..., N, 3)
+    and every row of `b` (..., M, 3). The displacements are computed in
+    `work`, a (..., N, M, 3) buffer, and the distances written to `out`.
+    """
+    diff = displacements(a, b, out=work)
+    return row_norms(diff, out=out, work=diff)
+
+
+def overlap_mask(dist, radii, other_radii, out=None, work=None, strict=False):
+    """
+    Returns the (..., N, M) mask of the pairs of spheres, with (..., N)
+    `radii` and (..., M) `other_radii`, whose centres are at most the sum of
+    their radii apart given their (..., N, M) distances `dist` (less than it
+    if `strict`), i.e. which touch or overlap. The sums of the radii are
+    computed in `work`, a float buffer of the same shape as `dist`.
+    """
+    reach = np.add(radii[..., :, None], other_radii[..., None, :], out=work)
+    compare = np.less if strict else np.less_equal
+    return compare(dist, reach, out=out)
+
+
+def first_hit(mask, out=None):
+    """
+    Returns the index of the first True entry along the last axis of `mask`,
+    or -1 where there is none (an int if `mask` is 1D).
+    """
+    if mask.shape[-1] == 0:
+        # argmax is undefined without any entries.
+        if mask.ndim == 1:
+            return -1
+        idx = np.empty(mask.shape[:-1], dtype=np.intp) if out is None else out
+        idx.fill(-1)
+        return idx
+
+    idx = np.argmax(mask, axis=-1, out=out)
+    hit = np.any(mask, axis=-1)
+    if np.ndim(idx) == 0:
+        return int(idx) if hit else -1
+    idx[~hit] = -1
+    return idx
+
+
+def _rescale_rows(v, norm, rescale, scale, out):
+    """
+    Writes `v` to `out` with the rows selected by the (..., 1) mask `rescale`
+    divided by their `norm` and multiplied by `scale`.
+    """
+    if out is None:
+        out = np.array(v, dtype=np.result_type(v, 1.))
+    elif out is not v:
+        np.copyto(out, v)
+    np.divide(out, norm, out=out, where=rescale)
+    if scale != 1.:
+        np.multiply(out, scale, out=out, where=rescale)
+    return out
+
+
+def normalise_rows(v, scale=1., out=None):
+    """
+    Row-wise `normalise` for an (N, 3) array. Rows with zero norm are
+    returned unchanged. The result is written to `out`, which may be `v`.
+    """
+    norm = row_norms(v)[..., None]
+    return _rescale_rows(v, norm, norm != 0, scale, out)
+
+
+def max_normalise_rows(v, out=None):
+    """
+    Row-wise `max_normalise` for an (N, 3) array, i.e. rows are clipped to a
+    norm of at most one. The result is written to `out`, which may be `v`.
+    """
+    norm = row_norms(v)[..., None]
+    return _rescale_rows(v, norm, norm >= 1, 1., out)
+
+
+def swept_sphere_contact(p0, p1, q0, q1, r):
+    """
+    For pairs of spheres whose centres move linearly from `p0` to `p1` and
+    from `q0` to `q1` over one step (all (K, 3) arrays), returns the (K,)
+    fraction of the step in [0, 1] at which the centres are first `r` apart,
+    i.e. the spheres first touch. Pairs which already overlap at the start
+    of the step give 0 and pairs which never touch give inf.
+    """
+    d0 = p0 - q0
+    dv = (p1 - p0) - (q1 - q0)
+    a = np.sum(np.square(dv), axis=-1)
+    b = 2 * np.sum(d0 * dv, axis=-1)
+    c = np.sum(np.square(d0), axis=-1) - np.square(r)
+    disc = np.square(b) - 4 * a * c
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (-b - np.sqrt(disc)) / (2 * a)
+    s = np.where((a > 0) & (disc >= 0) & (s >= 0) & (s <= 1), s, np.inf)
+
+    # Guard against rounding: overlapping at either end of the step must
+    # always count as a contact.
+    s = np.where(row_norms(p1 - q1) <= r, np.minimum(s, 1.), s)
+    return np.where(row_norms(d0) <= r, 0., s)
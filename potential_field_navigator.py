@@ -1,14 +1,66 @@
+import weakref
+
 import numpy as np
 
 from components import *
-from math_utils import normalise, max_normalise
+from field_cache import GridField
+from backends import get_backend
+from math_utils import normalise, max_normalise, normalise_rows, max_normalise_rows, row_norms
+
+
+# Number of spaceships whose pairwise interactions are evaluated at once by
+# the batched navigators. Bounds the (chunk, M, 3) temporaries so that very
+# large swarms do not allocate O(N^2) memory in a single step.
+BATCH_CHUNK_SIZE = 512
+
+
+def _chunks(n):
+    for start in range(0, n, BATCH_CHUNK_SIZE):
+        yield slice(start, min(start + BATCH_CHUNK_SIZE, n))
+
+
+def _exp_repulsion(points, point_radii, others, others_radii, mask=None, exclude_coincident=False, cutoff=None):
+    """
+    Dense kernel of `ProposedPotentialFieldNavigator.repulsive`, evaluated by
+    the current backend (see `backends.NumpyBackend.exp_repulsion`).
+    """
+    return get_backend().exp_repulsion(points, point_radii, others, others_radii, mask, exclude_coincident, cutoff)
+
+
+def _inverse_repulsion(points, others, threshold, mask=None, exclude_coincident=False):
+    """
+    Dense kernel of `BasicPotentialFieldNavigator.repulsive`, evaluated by
+    the current backend (see `backends.NumpyBackend.inverse_repulsion`).
+    """
+    return get_backend().inverse_repulsion(points, others, threshold, mask, exclude_coincident)
+
+
+def _sum_by_index(idx, values, n):
+    """
+    Returns the (n, 3) array whose i-th row is the sum of the rows of the
+    (K, 3) array `values` for which `idx` is i.
+    """
+    return np.stack([np.bincount(idx, weights=values[:, k], minlength=n) for k in range(3)], axis=-1)
+
+
+def _field_obstacles(env, spaceship_idx):
+    """
+    Returns (positions, radii) pairs for the planets, the asteroids and the
+    spaceships other than `spaceship_idx`, at the latest time recorded in
+    the trajectories of `env` (i.e. at `t` for `env.state_at_time(t)`).
+    """
+    others = np.arange(len(env.spaceships)) != spaceship_idx
+    return [(env.planet_positions, env.planet_radii),
+            (env._asteroid_trajectories.positions_at(-1), env.asteroid_radii),
+            (env._spaceship_trajectories.positions_at(-1)[others], env.spaceship_radii[others])]
+
 
 class PotentialFieldNavigator():
     def repulsive(self, env, spaceship_idx):
         return np.zeros((3,))
     
     def attractive(self, env, spaceship_idx):
-        cur_pos = env._spaceship_trajectories[spaceship_idx][-1]
+        cur_pos = env._spaceship_trajectories.body(spaceship_idx)[-1]
         direction = env.spaceships[spaceship_idx].goal - cur_pos
         return 0.1 * direction
     
@@ -20,35 +72,50 @@ class PotentialFieldNavigator():
         return self.attractive(env, spaceship_idx) + self.repulsive(env, spaceship_idx)
         # return np.array([0., 0., 0])
 
+    def repulsive_batch(self, env):
+        return np.zeros(env.spaceship_positions.shape)
+
+    def attractive_batch(self, env):
+        return 0.1 * (env.spaceship_goals - env.spaceship_positions)
+
+    def vector_batch(self, env):
+        """
+        Returns the (N, 3) array of `vector` for every spaceship in `env`.
+        """
+        return self.attractive_batch(env) + self.repulsive_batch(env)
+
+    def vector_ensemble(self, ensemble):
+        """
+        Returns the (K, N, 3) array of `vector` for every spaceship of every
+        environment in the `Ensemble`.
+        """
+        return self.attractive_batch(ensemble) + self.repulsive_batch(ensemble)
+
+    def field_at(self, env, spaceship_idx, points):
+        """
+        Returns the (P, 3) array of `vector` for the spaceship `spaceship_idx`
+        if it were at each row of the (P, 3) array `points`.
+        """
+        return 0.1 * (env.spaceship_goals[spaceship_idx] - points)
+
 
 class BasicPotentialFieldNavigator():
+    safety_dist = 0.2
+
     def repulsive(self, env, spaceship_idx):
         spaceship = env.spaceships[spaceship_idx]
-        result = np.zeros((3,))
-        safety_dist = 0.2
-
-        for planet in env.planets:
-            dist = euclidean_distance(spaceship.position, planet.position)
-            if dist < planet.radius + safety_dist:
-                result += 1/(spaceship.position - planet.position)
-
-        for asteroid in env.asteroids:
-            dist = euclidean_distance(spaceship.position, asteroid.position)
-            if dist < asteroid.radius + safety_dist:
-                result += 1/(spaceship.position - asteroid.position)
-
-        for other_spaceship in env.spaceships:
-            if np.array_equal(other_spaceship.position, spaceship.position):
-                continue 
-
-            dist = euclidean_distance(spaceship.position, other_spaceship.position)
-            if dist < spaceship.radius + safety_dist:
-                result += 1/(spaceship.position - other_spaceship.position)
-        
+        position = env.spaceship_positions[[spaceship_idx]]
+        safety_dist = self.safety_dist
+
+        result = _inverse_repulsion(position, env.planet_positions, env.planet_radii + safety_dist)[0]
+        result += _inverse_repulsion(position, env.asteroid_positions, env.asteroid_radii + safety_dist)[0]
+        # Other spaceships are avoided based on the spaceship's own radius.
+        result += _inverse_repulsion(position, env.spaceship_positions, spaceship.radius + safety_dist,
+                                     exclude_coincident=True)[0]
         return result
     
     def attractive(self, env, spaceship_idx):
-        cur_pos = env._spaceship_trajectories[spaceship_idx][-1]
+        cur_pos = env._spaceship_trajectories.body(spaceship_idx)[-1]
         direction = env.spaceships[spaceship_idx].goal - cur_pos
         return 0.05 * direction
     
@@ -59,39 +126,286 @@ class BasicPotentialFieldNavigator():
         """
         return self.attractive(env, spaceship_idx) + self.repulsive(env, spaceship_idx)
 
+    def repulsive_batch(self, env):
+        """
+        Only obstacles within `safety_dist` of their surface contribute, so
+        the contributing pairs are found with `env.spaceship_neighbour_pairs`
+        (which uses the environment's spatial index or neighbour lists, if it
+        has them).
+        """
+        positions = env.spaceship_positions
+        radii = env.spaceship_radii
+        result = np.zeros(positions.shape)
+
+        obstacles = [('planet', env.planet_positions, env.planet_radii),
+                     ('asteroid', env.asteroid_positions, env.asteroid_radii),
+                     ('spaceship', positions, None)]
+
+        for kind, others, others_radii in obstacles:
+            # Other spaceships are avoided based on the spaceship's own radius.
+            if others_radii is None:
+                threshold = radii + self.safety_dist
+            else:
+                threshold = np.max(others_radii, initial=0.) + self.safety_dist
+
+            point_idx, other_idx = env.spaceship_neighbour_pairs(kind, threshold)
+            diff = positions[point_idx] - others[other_idx]
+            dist = row_norms(diff)
+
+            if others_radii is None:
+                near = (dist < threshold[point_idx]) & ~np.all(diff == 0, axis=-1)
+            else:
+                near = dist < others_radii[other_idx] + self.safety_dist
+
+            with np.errstate(divide='ignore'):
+                result += _sum_by_index(point_idx[near], 1/diff[near], len(positions))
+
+        return result
+
+    def attractive_batch(self, env):
+        return 0.05 * (env.spaceship_goals - env.spaceship_positions)
+
+    def vector_batch(self, env):
+        """
+        Returns the (N, 3) array of `vector` for every spaceship in `env`.
+        """
+        return self.attractive_batch(env) + self.repulsive_batch(env)
+
+    def repulsive_ensemble(self, ensemble):
+        positions = ensemble.spaceship_positions
+        result = np.zeros(positions.shape)
+
+        for others, others_radii, others_mask in ((ensemble.planet_positions, ensemble.planet_radii, ensemble.planet_mask),
+                                                  (ensemble.asteroid_positions, ensemble.asteroid_radii, ensemble.asteroid_mask)):
+            threshold = others_radii[:, None, :] + self.safety_dist
+            result += _inverse_repulsion(positions, others, threshold, others_mask[:, None, :])
+
+        # Other spaceships are avoided based on the spaceship's own radius.
+        threshold = ensemble.spaceship_radii[:, :, None] + self.safety_dist
+        result += _inverse_repulsion(positions, positions, threshold, ensemble.spaceship_mask[:, None, :],
+                                     exclude_coincident=True)
+        return result
+
+    def vector_ensemble(self, ensemble):
+        """
+        Returns the (K, N, 3) array of `vector` for every spaceship of every
+        environment in the `Ensemble`.
+        """
+        return self.attractive_batch(ensemble) + self.repulsive_ensemble(ensemble)
+
+    def field_at(self, env, spaceship_idx, points):
+        """
+        Returns the (P, 3) array of `vector` for the spaceship `spaceship_idx`
+        if it were at each row of the (P, 3) array `points`.
+        """
+        (planets, planet_radii), (asteroids, asteroid_radii), (spaceships, _) = _field_obstacles(env, spaceship_idx)
+        radius = env.spaceship_radii[spaceship_idx]
+
+        repulsive = np.zeros_like(points, dtype=float)
+        for rows in _chunks(len(points)):
+            repulsive[rows] += _inverse_repulsion(points[rows], planets, planet_radii + self.safety_dist)
+            repulsive[rows] += _inverse_repulsion(points[rows], asteroids, asteroid_radii + self.safety_dist)
+            repulsive[rows] += _inverse_repulsion(points[rows], spaceships, radius + self.safety_dist,
+                                                  exclude_coincident=True)
+
+        return 0.05 * (env.spaceship_goals[spaceship_idx] - points) + repulsive
+
 
 class ProposedPotentialFieldNavigator():
+    def __init__(self, cutoff=None, planet_field_resolution=None):
+        """
+        If `cutoff` is set, obstacles whose surface is more than `cutoff` away
+        from the spaceship's surface are ignored (their weight is below
+        exp(-7 * cutoff)) and the remaining ones are found with
+        `env.neighbour_pairs`, so the cost per spaceship scales with its local
+        neighbourhood. Otherwise every obstacle contributes.
+
+        If `planet_field_resolution` is set, the repulsion from the (static)
+        planets is sampled once per environment on a grid with that many
+        points along each axis and then interpolated (see `_planet_field`),
+        so its cost no longer depends on the number of planets. Planets then
+        always contribute, whatever the `cutoff`. The ensemble path evaluates
+        them exactly.
+        """
+        self.cutoff = cutoff
+        self.planet_field_resolution = planet_field_resolution
+        self._planet_fields = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_planet_fields']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._planet_fields = weakref.WeakKeyDictionary()
+
+    def _planet_field(self, env):
+        """
+        Returns the GridField of sum_p exp(-7 * (|x - c_p| - r_p)) * (x - c_p)
+        over the planets p of `env`, which is the planet repulsion at x on a
+        spaceship of radius r_s divided by exp(7 * r_s). It is rebuilt
+        whenever a planet is added to or moved in `env`.
+        """
+        version, field = self._planet_fields.get(env, (None, None))
+        if version != env._planet_arrays.version:
+            edges = np.abs(np.array([env.xlen, env.ylen, env.zlen]) / 2)
+            planets, planet_radii = env.planet_positions.copy(), env.planet_radii.copy()
+            field = GridField(-edges, edges, self.planet_field_resolution,
+                              lambda points: _exp_repulsion(points, np.zeros(len(points)), planets, planet_radii))
+            self._planet_fields[env] = (env._planet_arrays.version, field)
+        return field
+
+    def _planet_repulsion(self, env, points, point_radii):
+        """
+        Returns the unnormalised repulsive vectors at `points` (spheres with
+        radii `point_radii`) from the planets, interpolated from
+        `_planet_field`.
+        """
+        return self._planet_field(env).lookup(points) * np.exp(7 * np.asarray(point_radii, dtype=np.float64))[:, None]
+
     def repulsive(self, env, spaceship_idx):
-        result = np.zeros((3,))
-        
-        spaceship = env.spaceships[spaceship_idx]
-        for planet in env.planets:
-            dist = euclidean_distance(spaceship.position, planet.position) - planet.radius - spaceship.radius
-            weight = np.exp(-7 * dist)
-            result += weight * (spaceship.position - planet.position)
-
-        for asteroid in env.asteroids:
-            dist = euclidean_distance(spaceship.position, asteroid.position) - asteroid.radius - spaceship.radius
-            weight = np.exp(-7 * dist)
-            result += weight * (spaceship.position - asteroid.position)
-
-        for other_spaceship in env.spaceships:
-            if np.array_equal(other_spaceship.position, spaceship.position):
-                continue 
-
-            dist = euclidean_distance(spaceship.position, other_spaceship.position) - other_spaceship.radius - spaceship.radius
-            weight = np.exp(-7 * dist)
-            result += weight * (spaceship.position - other_spaceship.position)
-        
-        return max_normalise(result)
+        rows = [spaceship_idx]
+        repulsive = self._repulsive_neighbours if self.cutoff is not None else self._repulsive_dense
+        return max_normalise(repulsive(env, env.spaceship_positions[rows], env.spaceship_radii[rows])[0])
 
     def attractive(self, env, spaceship_idx):
-        cur_pos = env._spaceship_trajectories[spaceship_idx][-1]
+        cur_pos = env._spaceship_trajectories.body(spaceship_idx)[-1]
         direction = env.spaceships[spaceship_idx].goal - cur_pos
         return normalise(direction)
 
     def vector(self, env, spaceship_idx):
         additive = self.attractive(env, spaceship_idx) + self.repulsive(env, spaceship_idx)
         if np.linalg.norm(additive) < 0.0:
-            additive = additive + np.random.normal(size=3)
-        return normalise(additive, scale=0.1)
\ No newline at end of file
+            additive = additive + env.rng.normal(size=3)
+        return normalise(additive, scale=0.1)
+
+    def _repulsive_neighbours(self, env, points, point_radii, all_spaceships=False):
+        """
+        Returns the unnormalised repulsive vectors at `points` (spheres with
+        radii `point_radii`) from every obstacle within `cutoff`. With
+        `all_spaceships`, `points` are the positions of all of the spaceships
+        of `env`, whose neighbours are found with
+        `env.spaceship_neighbour_pairs`.
+        """
+        result = np.zeros(points.shape)
+        obstacles = [('planet', env.planet_positions, env.planet_radii),
+                     ('asteroid', env.asteroid_positions, env.asteroid_radii),
+                     ('spaceship', env.spaceship_positions, env.spaceship_radii)]
+        if self.planet_field_resolution is not None:
+            result += self._planet_repulsion(env, points, point_radii)
+            obstacles = obstacles[1:]
+
+        for kind, others, others_radii in obstacles:
+            r = self.cutoff + point_radii + np.max(others_radii, initial=0.)
+            if all_spaceships:
+                point_idx, other_idx = env.spaceship_neighbour_pairs(kind, r)
+            else:
+                point_idx, other_idx = env.neighbour_pairs(kind, points, r)
+            diff = points[point_idx] - others[other_idx]
+            dist = row_norms(diff) - others_radii[other_idx] - point_radii[point_idx]
+
+            near = dist < self.cutoff
+            if kind == 'spaceship':
+                near &= ~np.all(diff == 0, axis=-1)
+
+            weight = np.exp(-7 * np.asarray(dist[near], dtype=np.float64))
+            result += _sum_by_index(point_idx[near], weight[:, None] * diff[near], len(points))
+
+        return result
+
+    def _repulsive_dense(self, env, points, point_radii):
+        """
+        Returns the unnormalised repulsive vectors at `points` (spheres with
+        radii `point_radii`) from every obstacle, a chunk of points at a time.
+        """
+        result = np.zeros(points.shape)
+        if self.planet_field_resolution is not None:
+            result += self._planet_repulsion(env, points, point_radii)
+
+        for rows in _chunks(len(points)):
+            obstacles = [(env.planet_positions, env.planet_radii),
+                         (env.asteroid_positions, env.asteroid_radii),
+                         (env.spaceship_positions, env.spaceship_radii)]
+
+            for i, (others, others_radii) in enumerate(obstacles):
+                if i == 0 and self.planet_field_resolution is not None:
+                    continue
+                result[rows] += _exp_repulsion(points[rows], point_radii[rows], others, others_radii,
+                                               exclude_coincident=i == 2)
+
+        return result
+
+    def repulsive_batch(self, env):
+        positions = env.spaceship_positions
+        radii = env.spaceship_radii
+        if self.cutoff is not None:
+            repulsive = self._repulsive_neighbours(env, positions, radii, all_spaceships=True)
+        else:
+            repulsive = self._repulsive_dense(env, positions, radii)
+        return max_normalise_rows(repulsive, out=repulsive)
+
+    def attractive_batch(self, env):
+        return normalise_rows(env.spaceship_goals - env.spaceship_positions)
+
+    def vector_batch(self, env):
+        """
+        Returns the (N, 3) array of `vector` for every spaceship in `env`.
+        """
+        additive = self.attractive_batch(env) + self.repulsive_batch(env)
+        stuck = row_norms(additive) < 0.0
+        if np.any(stuck):
+            additive[stuck] += env.rng.normal(size=(np.sum(stuck), 3))
+        return normalise_rows(additive, scale=0.1, out=additive)
+
+    def repulsive_ensemble(self, ensemble):
+        positions = ensemble.spaceship_positions
+        radii = ensemble.spaceship_radii
+        result = np.zeros(positions.shape)
+
+        obstacles = [(ensemble.planet_positions, ensemble.planet_radii, ensemble.planet_mask),
+                     (ensemble.asteroid_positions, ensemble.asteroid_radii, ensemble.asteroid_mask),
+                     (positions, radii, ensemble.spaceship_mask)]
+
+        for i, (others, others_radii, others_mask) in enumerate(obstacles):
+            result += _exp_repulsion(positions, radii, others, others_radii, others_mask[:, None, :],
+                                     exclude_coincident=i == 2, cutoff=self.cutoff)
+
+        return max_normalise_rows(result, out=result)
+
+    def vector_ensemble(self, ensemble):
+        """
+        Returns the (K, N, 3) array of `vector` for every spaceship of every
+        environment in the `Ensemble`.
+        """
+        additive = self.attractive_batch(ensemble) + self.repulsive_ensemble(ensemble)
+        stuck = row_norms(additive) < 0.0
+        if np.any(stuck):
+            additive[stuck] += ensemble.rng.normal(size=(np.sum(stuck), 3))
+        return normalise_rows(additive, scale=0.1, out=additive)
+
+    def field_at(self, env, spaceship_idx, points):
+        """
+        Returns the (P, 3) array of `vector` for the spaceship `spaceship_idx`
+        if it were at each row of the (P, 3) array `points`.
+        """
+        obstacles = _field_obstacles(env, spaceship_idx)
+        radius = env.spaceship_radii[spaceship_idx]
+
+        repulsive = np.zeros_like(points, dtype=float)
+        if self.planet_field_resolution is not None:
+            repulsive += self._planet_repulsion(env, points, np.full(len(points), radius))
+
+        for rows in _chunks(len(points)):
+            point_radii = np.full(len(points[rows]), radius)
+            for i, (others, others_radii) in enumerate(obstacles):
+                if i == 0 and self.planet_field_resolution is not None:
+                    continue
+                repulsive[rows] += _exp_repulsion(points[rows], point_radii, others, others_radii,
+                                                  exclude_coincident=i == 2, cutoff=self.cutoff)
+
+        additive = normalise_rows(env.spaceship_goals[spaceship_idx] - points) + max_normalise_rows(repulsive)
+        stuck = row_norms(additive) < 0.0
+        if np.any(stuck):
+            additive[stuck] += env.rng.normal(size=(np.sum(stuck), 3))
+        return normalise_rows(additive, scale=0.1, out=additive)
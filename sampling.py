@@ -0,0 +1,114 @@
+import itertools
+
+import numpy as np
+
+from math_utils import pairwise_distances, overlap_mask
+
+
+# Largest number of candidate positions drawn at once by rejection sampling.
+SAMPLE_BATCH_SIZE = 1024
+
+# Default bound on the number of candidates drawn for a single position
+# before sampling gives up.
+MAX_SAMPLE_ATTEMPTS = 100000
+
+# Existing spheres which would span more than this many grid cells along an
+# axis are tested against every candidate rather than registered in the grid.
+MAX_CELLS_PER_AXIS = 4
+
+
+def overlapping(candidates, radius, positions, radii):
+    """
+    Returns the (B,) mask of the rows of the (B, 3) array `candidates` which,
+    as spheres of radius `radius`, touch or overlap one of the spheres at the
+    (M, 3) `positions` with (M,) `radii`.
+    """
+    dists = pairwise_distances(candidates, positions)
+    return np.any(overlap_mask(dists, np.full(len(candidates), radius), radii), axis=1)
+
+
+def rejection_sample(rng, low, high, rejected, max_attempts=MAX_SAMPLE_ATTEMPTS):
+    """
+    Returns the first position drawn uniformly from the box [`low`, `high`]
+    which is not rejected by `rejected`, a function mapping a (B, 3) array of
+    candidates to a (B,) mask. Candidates are drawn in batches which double
+    in size, up to SAMPLE_BATCH_SIZE, after every rejected batch, so a sparse
+    box costs a single draw and a crowded one is tested many candidates at a
+    time. Raises a RuntimeError after `max_attempts` rejected candidates.
+    """
+    batch_size, attempts = 1, 0
+    while attempts < max_attempts:
+        batch_size = min(batch_size, max_attempts - attempts)
+        candidates = rng.uniform(low=low, high=high, size=(batch_size, 3))
+        valid = np.flatnonzero(~rejected(candidates))
+        if len(valid):
+            return candidates[valid[0]]
+
+        attempts += batch_size
+        batch_size = min(2 * batch_size, SAMPLE_BATCH_SIZE)
+
+    raise RuntimeError(f"Could not find a valid position in {max_attempts} attempts.")
+
+
+def dart_throwing(rng, low, high, radii, positions=None, position_radii=None,
+                  max_attempts=MAX_SAMPLE_ATTEMPTS):
+    """
+    Places spheres with the given (N,) `radii` one after the other at
+    positions drawn uniformly from the box [`low`, `high`], so that none of
+    them touches another or one of the existing spheres at the (M, 3)
+    `positions` with (M,) `position_radii`. Returns the (N, 3) positions.
+
+    Every placed sphere is registered in the cells of a uniform grid (with
+    cells as wide as the largest new sphere) which it could reach, so testing
+    a candidate only looks at the spheres registered in its own cell and the
+    total cost is close to linear in N. Existing spheres much larger than the
+    cells (e.g. planets when placing spaceships) are instead tested against
+    every candidate. Raises a RuntimeError if a sphere cannot be placed in
+    `max_attempts` candidates.
+    """
+    low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+    radii = np.asarray(radii, dtype=float).reshape(-1)
+    cell_size = 2 * np.max(radii, initial=0.)
+    if cell_size == 0:
+        cell_size = np.max(high - low, initial=1.) or 1.
+    max_radius = np.max(radii, initial=0.)
+
+    placed_positions, placed_radii = [], []
+    cells = {}
+    large_positions, large_radii = np.empty((0, 3)), np.empty((0,))
+
+    def register(pos, r):
+        idx = len(placed_positions)
+        placed_positions.append(pos)
+        placed_radii.append(r)
+        # Any new sphere touching this one has its centre within r +
+        # max_radius of it, so only those cells can hold such a centre.
+        first = np.floor((pos - r - max_radius - low) / cell_size).astype(int)
+        last = np.floor((pos + r + max_radius - low) / cell_size).astype(int)
+        for key in itertools.product(*(range(a, b + 1) for a, b in zip(first, last))):
+            cells.setdefault(key, []).append(idx)
+
+    if positions is not None:
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        position_radii = np.asarray(position_radii, dtype=float).reshape(-1)
+        large = 2 * (position_radii + max_radius) > MAX_CELLS_PER_AXIS * cell_size
+        large_positions, large_radii = positions[large], position_radii[large]
+        for pos, r in zip(positions[~large], position_radii[~large]):
+            register(pos, r)
+
+    result = np.empty((len(radii), 3))
+    for i, r in enumerate(radii):
+        def rejected(candidates):
+            mask = overlapping(candidates, r, large_positions, large_radii)
+            keys = np.floor((candidates - low) / cell_size).astype(int)
+            for j, key in enumerate(map(tuple, keys)):
+                near = cells.get(key)
+                if near and not mask[j]:
+                    mask[j] = overlapping(candidates[j:j + 1], r, np.array([placed_positions[k] for k in near]),
+                                          np.array([placed_radii[k] for k in near]))[0]
+            return mask
+
+        result[i] = rejection_sample(rng, low, high, rejected, max_attempts)
+        register(result[i], r)
+
+    return result
@@ -0,0 +1,163 @@
+import glob
+import gzip
+import os
+
+import numpy as np
+
+from trajectories import CHUNK_SIZE
+
+
+# The arrays written by every sink, with the shape and dtype of a single step
+# of `env`.
+def _step_shapes(env):
+    return {'times': ((), np.float64),
+            'spaceships': ((len(env.spaceships), 3), env.dtype),
+            'asteroids': ((len(env.asteroids), 3), env.dtype)}
+
+
+def _step_values(state):
+    return {'times': state.t, 'spaceships': state.spaceship_positions, 'asteroids': state.asteroid_positions}
+
+
+class NpyChunkSink:
+    """
+    Streams the states yielded by `Environment.run_iter` to a directory of
+    .npy files, one per array ('times', 'spaceships' and 'asteroids') and
+    chunk of `chunk_size` steps, e.g. `spaceships_00002.npy` holds the
+    (chunk_size, N, 3) spaceship positions of steps 2 * chunk_size onwards.
+
+    Each step is written straight into a memory-mapped file, so memory use
+    does not depend on the length of the run. A chunk is written as
+    `<name>_<index>.npy.part` and renamed once it is complete, so
+    `iter_npy_chunks` can read the finished chunks while the simulation is
+    still running.
+    """
+    def __init__(self, directory, chunk_size=CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def _path(self, name, chunk):
+        return os.path.join(self.directory, f'{name}_{chunk:05d}.npy')
+
+    def open(self, env):
+        os.makedirs(self.directory, exist_ok=True)
+        self._shapes = _step_shapes(env)
+        self._chunk = 0
+        self._n_steps = 0
+        self._maps = None
+
+    def _start_chunk(self):
+        self._maps = {name: np.lib.format.open_memmap(self._path(name, self._chunk) + '.part', mode='w+',
+                                                      shape=(self.chunk_size, *shape), dtype=dtype)
+                      for name, (shape, dtype) in self._shapes.items()}
+
+    def _finish_chunk(self):
+        maps, self._maps = self._maps, None
+        for name in list(maps):
+            array = maps.pop(name)
+            path = self._path(name, self._chunk)
+            if self._n_steps < self.chunk_size:
+                # Only the last chunk can be partial; rewrite it without the
+                # unused rows.
+                np.save(path, array[:self._n_steps])
+                del array
+                os.remove(path + '.part')
+            else:
+                array.flush()
+                del array
+                os.replace(path + '.part', path)
+
+        self._chunk += 1
+        self._n_steps = 0
+
+    def write(self, state):
+        if self._maps is None:
+            self._start_chunk()
+        for name, value in _step_values(state).items():
+            self._maps[name][self._n_steps] = value
+
+        self._n_steps += 1
+        if self._n_steps == self.chunk_size:
+            self._finish_chunk()
+
+    def close(self):
+        if self._maps is not None:
+            self._finish_chunk()
+
+
+class GzipSink:
+    """
+    Streams the states yielded by `Environment.run_iter` to one append-only,
+    gzip-compressed file per array, `<name>.npy.gz` in `directory`. Steps are
+    buffered in memory `chunk_size` at a time and every chunk is appended as
+    a separate .npy record in its own gzip member, so the files can be read
+    (with `iter_gzip_chunks`) up to the last complete chunk while the
+    simulation is still running, and an interrupted run loses at most one
+    chunk.
+    """
+    def __init__(self, directory, chunk_size=CHUNK_SIZE, compresslevel=6):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.npy.gz')
+
+    def open(self, env):
+        os.makedirs(self.directory, exist_ok=True)
+        shapes = _step_shapes(env)
+        self._buffers = {name: np.empty((self.chunk_size, *shape), dtype=dtype)
+                         for name, (shape, dtype) in shapes.items()}
+        self._n_steps = 0
+        for name in shapes:
+            # Start from empty files rather than appending to an earlier run.
+            open(self._path(name), 'wb').close()
+
+    def _flush(self):
+        for name, buffer in self._buffers.items():
+            with gzip.open(self._path(name), 'ab', compresslevel=self.compresslevel) as f:
+                np.lib.format.write_array(f, buffer[:self._n_steps])
+        self._n_steps = 0
+
+    def write(self, state):
+        for name, value in _step_values(state).items():
+            self._buffers[name][self._n_steps] = value
+
+        self._n_steps += 1
+        if self._n_steps == self.chunk_size:
+            self._flush()
+
+    def close(self):
+        if self._n_steps:
+            self._flush()
+
+
+def iter_npy_chunks(directory, name='spaceships', mmap_mode='r'):
+    """
+    Yields the completed chunks of the array `name` written by an
+    NpyChunkSink to `directory`, in order, memory-mapped with `mmap_mode`.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, f'{name}_*.npy'))):
+        yield np.load(path, mmap_mode=mmap_mode)
+
+
+def iter_gzip_chunks(directory, name='spaceships'):
+    """
+    Yields the completed chunks of the array `name` written by a GzipSink to
+    `directory`, in order.
+    """
+    with gzip.open(os.path.join(directory, f'{name}.npy.gz'), 'rb') as f:
+        try:
+            while f.peek(1):
+                yield np.lib.format.read_array(f)
+        except EOFError:
+            # The last chunk is still being written.
+            return
+
+
+def load_chunks(chunks):
+    """
+    Concatenates the chunks yielded by `iter_npy_chunks` or
+    `iter_gzip_chunks` into a single array, e.g. the (T, N, 3) trajectories.
+    """
+    return np.concatenate(list(chunks))
@@ -0,0 +1,123 @@
+import numpy as np
+
+from math_utils import pairwise_distances, row_norms
+
+
+# Integer cell coordinates are packed into a single int64 key. Each axis gets
+# 20 bits, so cells up to +/- 2^19 away from the origin can be addressed.
+_KEY_BITS = 20
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+# Number of query points handled at once by the brute-force fallback.
+PAIRS_CHUNK_SIZE = 512
+
+
+def _empty_pairs():
+    return np.empty((0,), dtype=np.int64), np.empty((0,), dtype=np.int64)
+
+
+def pairs_within(points, others, r):
+    """
+    Brute-force counterpart of `UniformGrid.query_pairs`. Returns index arrays
+    (point_idx, other_idx) of every row of `others` whose distance to a row of
+    `points` is at most `r` (a scalar or one radius per point).
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    others = np.asarray(others, dtype=float).reshape(-1, 3)
+    r = np.broadcast_to(np.asarray(r, dtype=float), (len(points),))
+    if len(points) == 0 or len(others) == 0:
+        return _empty_pairs()
+
+    # The chunks share their buffers, so only the first one allocates them.
+    chunk_size = min(len(points), PAIRS_CHUNK_SIZE)
+    work = np.empty((chunk_size, len(others), 3))
+    dist = np.empty((chunk_size, len(others)))
+
+    point_idx, other_idx = [], []
+    for start in range(0, len(points), PAIRS_CHUNK_SIZE):
+        rows = slice(start, start + PAIRS_CHUNK_SIZE)
+        n = len(points[rows])
+        pairwise_distances(points[rows], others, out=dist[:n], work=work[:n])
+        i, j = np.nonzero(dist[:n] <= r[rows, None])
+        point_idx.append(i + start)
+        other_idx.append(j)
+
+    return np.concatenate(point_idx), np.concatenate(other_idx)
+
+
+class UniformGrid:
+    """
+    A uniform hash grid over a fixed set of (N, 3) points which answers
+    "which points lie within r of p" queries. Points are bucketed into cubic
+    cells of side `cell_size` and a query only visits the cells overlapping
+    its bounding box, so its cost scales with the local density of points
+    rather than with N. The grid is cheap to build, so dynamic bodies simply
+    get a new grid whenever they move.
+    """
+    def __init__(self, points, cell_size):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+
+        keys = self._keys(self._cells(self.points))
+        self._order = np.argsort(keys, kind='stable')
+        self._cell_keys, self._starts, counts = np.unique(keys[self._order],
+                                                          return_index=True,
+                                                          return_counts=True)
+        self._ends = self._starts + counts
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, points):
+        return np.floor(points / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _keys(cells):
+        c = cells + _KEY_OFFSET
+        return (c[..., 0] << (2 * _KEY_BITS)) | (c[..., 1] << _KEY_BITS) | c[..., 2]
+
+    def query(self, point, r):
+        """
+        Returns the sorted indices of the points within `r` of `point`.
+        """
+        _, idx = self.query_pairs(np.asarray(point)[None, :], r)
+        return np.sort(idx)
+
+    def query_pairs(self, points, r):
+        """
+        Returns index arrays (point_idx, grid_idx) of every grid point whose
+        distance to a row of `points` is at most `r` (a scalar or one radius
+        per query point).
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        r = np.broadcast_to(np.asarray(r, dtype=float), (len(points),))
+        if len(points) == 0 or len(self.points) == 0:
+            return _empty_pairs()
+
+        lo = self._cells(points - r[:, None])
+        hi = self._cells(points + r[:, None])
+        span = int(np.max(hi - lo)) + 1
+
+        # Visiting more cells than are occupied is slower than checking every
+        # point, e.g. for a very large radius.
+        if span ** 3 > len(self._cell_keys):
+            return pairs_within(points, self.points, r)
+
+        axis = np.arange(span)
+        offsets = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+        cells = lo[:, None, :] + offsets[None, :, :]
+        query_idx, offset_idx = np.nonzero(np.all(cells <= hi[:, None, :], axis=-1))
+        keys = self._keys(cells[query_idx, offset_idx])
+
+        slot = np.minimum(np.searchsorted(self._cell_keys, keys), len(self._cell_keys) - 1)
+        occupied = self._cell_keys[slot] == keys
+        query_idx, slot = query_idx[occupied], slot[occupied]
+
+        # Expand each visited cell into the points it contains.
+        counts = self._ends[slot] - self._starts[slot]
+        point_idx = np.repeat(query_idx, counts)
+        within_cell = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        grid_idx = self._order[np.repeat(self._starts[slot], counts) + within_cell]
+
+        keep = row_norms(points[point_idx] - self.points[grid_idx]) <= r[point_idx]
+        return point_idx[keep], grid_idx[keep]
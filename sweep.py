@@ -0,0 +1,183 @@
+import glob
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from experiments import collision_rate_experiment
+
+
+DEFAULT_CACHE_DIR = '.sweep_cache'
+
+# Config keys which only affect how an experiment is executed, not its
+# result, and so are left out of the cache key.
+EXECUTION_KEYS = ('n_workers',)
+
+
+def expand_grid(base_config, grid):
+    """
+    Returns the list of configs obtained by overriding `base_config` with
+    every combination of the values in `grid`, a dict mapping config keys to
+    lists of values, e.g. {'n_asteroids': [5, 10], 'dt': [0.01, 0.005]}.
+    The last key varies fastest.
+    """
+    keys = list(grid)
+    return [{**base_config, **dict(zip(keys, values))}
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def canonical(value):
+    """
+    Returns a JSON-serialisable representation of a config value which is
+    the same for equal configs across processes and sessions. Objects such as
+    navigators are represented by their class and public attributes (private
+    ones hold caches rather than configuration), and objects without
+    attributes by their repr. Dtypes, given either as np.dtype or as a
+    scalar type such as np.float32, are represented by their name, so the
+    two spellings share a cache entry.
+    """
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return canonical(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.dtype):
+        return {'dtype': value.name}
+    if isinstance(value, type):
+        if issubclass(value, np.generic):
+            return {'dtype': np.dtype(value).name}
+        return {'class': f'{value.__module__}.{value.__qualname__}'}
+    if not hasattr(value, '__dict__'):
+        return {'class': f'{type(value).__module__}.{type(value).__qualname__}', 'repr': repr(value)}
+    return {'class': f'{type(value).__module__}.{type(value).__qualname__}',
+            'attributes': canonical({k: v for k, v in vars(value).items() if not k.startswith('_')})}
+
+
+def code_version(directory=None):
+    """
+    Returns a hash of the source of every module in `directory` (by default
+    the directory containing this file), so that cached results are not
+    reused once the simulation code changes.
+    """
+    directory = directory if directory is not None else os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def config_key(config, version, experiment=collision_rate_experiment):
+    """
+    Returns the cache key of running `experiment` with `config` (including
+    its seed) for the code version `version`.
+    """
+    config = {k: v for k, v in config.items() if k not in EXECUTION_KEYS}
+    payload = json.dumps({'config': canonical(config), 'seed': canonical(config.get('seed')),
+                          'experiment': f'{experiment.__module__}.{experiment.__qualname__}',
+                          'version': version}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    A directory of JSON files, one per completed sweep point, keyed by
+    `config_key`. Each result is written as soon as its point completes (via
+    a temporary file and an atomic rename), so an interrupted sweep loses at
+    most the point which was running.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _entries(self):
+        return glob.glob(os.path.join(self.directory, '*.json'))
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """
+        Returns the cached result for `key`, or None if there is none.
+        """
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)['result']
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, config, result):
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'config': canonical(config), 'result': result, 'created': time.time()}, f)
+        os.replace(tmp_path, self._path(key))
+
+    def evict(self, max_entries=None, max_age=None):
+        """
+        Removes the entries older than `max_age` seconds and then, if more
+        than `max_entries` remain, the least recently written ones. Returns
+        the number of entries removed.
+        """
+        paths = sorted(self._entries(), key=os.path.getmtime)
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            expired = [path for path in paths if os.path.getmtime(path) < cutoff]
+            paths = paths[len(expired):]
+        else:
+            expired = []
+        if max_entries is not None and len(paths) > max_entries:
+            expired += paths[:len(paths) - max_entries]
+
+        for path in expired:
+            os.remove(path)
+        return len(expired)
+
+    def clear(self):
+        return self.evict(max_entries=0)
+
+
+def run_sweep(base_config, grid, cache=None, experiment=collision_rate_experiment, refresh=False):
+    """
+    Runs `experiment` (by default `collision_rate_experiment`) for every
+    config in `expand_grid(base_config, grid)` and returns a list of
+    (config, result) pairs in grid order.
+
+    Results are looked up in and stored to `cache` (a ResultCache, by default
+    one in DEFAULT_CACHE_DIR), so re-running a sweep, or one which shares
+    points with an earlier sweep, only runs the missing points. Set `refresh`
+    to re-run every point regardless. Results are only reproducible if the
+    configs have a 'seed', so configs without one are always run and never
+    cached.
+    """
+    cache = cache if cache is not None else ResultCache()
+    version = code_version()
+
+    results = []
+    for config in expand_grid(base_config, grid):
+        if config.get('seed') is None:
+            results.append((config, experiment(config)))
+            continue
+
+        key = config_key(config, version, experiment)
+        result = None if refresh else cache.get(key)
+        if result is None:
+            result = experiment(config)
+            cache.put(key, config, result)
+        results.append((config, result))
+
+    return results
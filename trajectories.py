@@ -0,0 +1,167 @@
+import numpy as np
+
+
+# Number of time steps by which a buffer grows when it runs out of space.
+CHUNK_SIZE = 256
+
+
+class TrajectoryBuffer:
+    """
+    Preallocated storage for the trajectories of N bodies as a single
+    (T, N, 3) array, where row t holds the positions of every body at time
+    index t, together with the (T,) array of the simulated time of each
+    index. If the number of time steps is not known in advance, the buffer
+    grows by `chunk_size` rows at a time.
+
+    `array`, `positions_at` and `body` return views rather than copies, and so
+    does `truncated`: a truncated buffer shares memory with the buffer it was
+    taken from until it is itself appended to, at which point it copies its
+    data first.
+
+    Positions are stored as `dtype`; the times are always float64.
+    """
+    def __init__(self, initial_positions, capacity=None, chunk_size=CHUNK_SIZE, t0=0., dtype=np.float64):
+        initial_positions = np.asarray(initial_positions, dtype=dtype).reshape(-1, 3)
+        self.chunk_size = chunk_size
+        capacity = max(1, capacity if capacity is not None else chunk_size)
+        self._data = np.empty((capacity, len(initial_positions), 3), dtype=dtype)
+        self._data[0] = initial_positions
+        self._times = np.empty(capacity)
+        self._times[0] = t0
+        self._n_steps = 1
+        self._shared = False
+        self.n_discarded = 0
+
+    @classmethod
+    def from_array(cls, trajectories, capacity=None, chunk_size=CHUNK_SIZE, times=None, dtype=np.float64):
+        """
+        Returns a TrajectoryBuffer holding a copy of the (T, N, 3) array
+        `trajectories` at the (T,) `times`, by default the time indices.
+        """
+        trajectories = np.asarray(trajectories, dtype=dtype)
+        buffer = cls(trajectories[0], max(len(trajectories), capacity or 0), chunk_size, dtype=dtype)
+        buffer._data[:len(trajectories)] = trajectories
+        buffer._times[:len(trajectories)] = times if times is not None else np.arange(len(trajectories))
+        buffer._n_steps = len(trajectories)
+        return buffer
+
+    def __len__(self):
+        return self._n_steps
+
+    @property
+    def n_bodies(self):
+        return self._data.shape[1]
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def array(self):
+        """
+        The (T, N, 3) view of the recorded trajectories.
+        """
+        return self._data[:self._n_steps]
+
+    @property
+    def times(self):
+        """
+        The (T,) view of the time of each recorded time index.
+        """
+        return self._times[:self._n_steps]
+
+    def positions_at(self, index):
+        """
+        Returns an (N, 3) view of the positions of every body at time index
+        `index`.
+        """
+        return self.array[index]
+
+    def body(self, idx):
+        """
+        Returns a (T, 3) view of the trajectory of the body `idx`.
+        """
+        return self.array[:, idx]
+
+    def interpolated(self, t):
+        """
+        Returns the (N, 3) positions of every body at time `t`, linearly
+        interpolated between the recorded time indices on either side of it
+        (and clamped to the first and last ones).
+        """
+        times = self.times
+        if t <= times[0]:
+            return self.array[0].copy()
+        if t >= times[-1]:
+            return self.array[-1].copy()
+
+        upper = int(np.searchsorted(times, t))
+        frac = (t - times[upper - 1]) / (times[upper] - times[upper - 1])
+        return self.array[upper - 1] + frac * (self.array[upper] - self.array[upper - 1])
+
+    def _ensure_owned(self):
+        if self._shared:
+            self._data = self._data.copy()
+            self._times = self._times.copy()
+            self._shared = False
+
+    def append(self, positions, t):
+        """
+        Records the (N, 3) positions of every body at the next time index,
+        which is at time `t`.
+        """
+        self._ensure_owned()
+        if self._n_steps == len(self._data):
+            new_data = np.empty((len(self._data) + self.chunk_size, *self._data.shape[1:]), dtype=self.dtype)
+            new_data[:self._n_steps] = self.array
+            self._data = new_data
+            new_times = np.empty(len(self._data))
+            new_times[:self._n_steps] = self.times
+            self._times = new_times
+
+        self._data[self._n_steps] = positions
+        self._times[self._n_steps] = t
+        self._n_steps += 1
+
+    def add_body(self, position):
+        """
+        Adds a column for a new body. The body is taken to have been at
+        `position` for every time index recorded so far.
+        """
+        self._ensure_owned()
+        new_data = np.empty((len(self._data), self.n_bodies + 1, 3), dtype=self.dtype)
+        new_data[:, :-1] = self._data
+        new_data[:self._n_steps, -1] = position
+        self._data = new_data
+
+    def truncated(self, n_steps):
+        """
+        Returns a TrajectoryBuffer holding the first `n_steps` time indices
+        of this one, without copying.
+        """
+        buffer = TrajectoryBuffer.__new__(TrajectoryBuffer)
+        buffer.chunk_size = self.chunk_size
+        buffer._data = self._data[:max(1, min(n_steps, self._n_steps))]
+        buffer._times = self._times[:len(buffer._data)]
+        buffer._n_steps = len(buffer._data)
+        buffer._shared = True
+        buffer.n_discarded = self.n_discarded
+        return buffer
+
+    def discard_history(self):
+        """
+        Drops every time index but the latest, e.g. once they have been
+        streamed elsewhere, so that the buffer does not grow however long the
+        simulation runs. Storage beyond `chunk_size` time indices (e.g.
+        preallocated for the whole run) is released. `n_discarded` counts the
+        time indices dropped so far.
+        """
+        positions, t = self.array[-1], self.times[-1]
+        if self._shared or len(self._data) > self.chunk_size:
+            self._data = np.empty((min(len(self._data), self.chunk_size), *self._data.shape[1:]), dtype=self.dtype)
+            self._times = np.empty(len(self._data))
+            self._shared = False
+        self._data[0] = positions
+        self._times[0] = t
+        self.n_discarded += self._n_steps - 1
+        self._n_steps = 1
@@ -1,5 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.animation import FuncAnimation
+from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
 
 from components import *
 from math_utils import find_circle
@@ -21,16 +25,15 @@ def plot_walls(env, z=0):
     plt.ylim([-env.ylen/2 - GRID_OFFSET, env.ylen/2 + GRID_OFFSET])
 
 
-def plot_lines(lst, color_str=None):
+def plot_lines(trajectories, color_str=None):
     """
-    For a list of lists of numpy arrays of 3D points, plot the x 
-    and y components of the 3D points in the color `color_str`.
+    For a (T, N, 3) array of the 3D positions of N objects over T
+    time steps, plot the x and y components of each object's
+    trajectory in the color `color_str`.
     """
     color_str = color_str if color_str is not None else 'k'
-    for line in lst:    
-        points = np.stack(line)
-        x, y = points[:, 0], points[:, 1]
-        plt.plot(x, y, color_str)
+    if trajectories.shape[1] > 0:
+        plt.plot(trajectories[:, :, 0], trajectories[:, :, 1], color_str)
 
 
 def plot_marker(pos, marker_str=None, color_str=None):
@@ -62,47 +65,200 @@ def plot_goals(env):
         plot_marker(spaceship.goal)
 
 
-def plot_potential_field(env, spaceship_idx, t=None):
+def plot_potential_field(env, spaceship_idx, t=None, z=0, resolution=RESOLUTION):
     """
     Given the location of a series of planets, asteroids and
     spaceships at time `t`, produce the 2D vector field associated 
-    with the spaceship indexed by `spaceship_idx`.
+    with the spaceship indexed by `spaceship_idx` in the plane at
+    height `z`, sampled on a `resolution` x `resolution` grid.
     """
+    state = env.state_at_time(t) if t is not None else env
 
     # Potential Field Plotting
-    x = np.linspace(-env.xlen/2, env.xlen/2, RESOLUTION)
-    y = np.linspace(-env.ylen/2, env.ylen/2, RESOLUTION)
+    x = np.linspace(-env.xlen/2, env.xlen/2, resolution)
+    y = np.linspace(-env.ylen/2, env.ylen/2, resolution)
     X, Y = np.meshgrid(x, y)
-    U, V = np.zeros_like(X), np.zeros_like(Y)
+    points = np.stack([X.ravel(), Y.ravel(), np.full(X.size, float(z))], axis=-1)
 
-    for i in range(len(U)):
-        for j in range(len(V)):
-            if t is not None:
-                velocity = env.navigator.vector(env.state_at_time(t), spaceship_idx)
-            else:
-                velocity = env.navigator.vector(env, spaceship_idx)
-            U[i, j] = velocity[0]
-            V[i, j] = velocity[1]
+    velocity = env.navigator.field_at(state, spaceship_idx, points)
+    U = velocity[:, 0].reshape(X.shape)
+    V = velocity[:, 1].reshape(Y.shape)
 
     plt.quiver(X, Y, U, V, units='width')
 
 
-def plot_env(env, z=0, t=None, potential_field=False, filename=None):
+def decimate(trajectories, max_points):
+    """
+    Returns the rows of the (T, ...) `trajectories` at (at most) `max_points`
+    evenly spaced time indices, always including the first and last, so that
+    long trajectories are drawn with about one point per pixel.
+    """
+    if max_points is None or len(trajectories) <= max_points:
+        return trajectories
+    idx = np.unique(np.linspace(0, len(trajectories) - 1, max(2, max_points)).round().astype(int))
+    return trajectories[idx]
+
+
+def screen_points(ax):
+    """
+    Returns the width of `ax` in pixels, the number of points worth drawing
+    along a trajectory which spans it.
+    """
+    return max(2, int(ax.get_window_extent().width))
+
+
+def _segments(trajectories, max_points):
+    return np.swapaxes(decimate(trajectories, max_points)[:, :, :2], 0, 1)
+
+
+def _circles(positions, radii, z):
+    """
+    Returns Circle patches for the intersections of the plane at height `z`
+    with the spheres at the (N, 3) `positions` with (N,) `radii`, as in
+    `find_circle`.
+    """
+    d = z - positions[:, 2]
+    cut = (z > positions[:, 2] - radii) & (z < positions[:, 2] + radii)
+    radius = np.sqrt(np.square(radii[cut]) - np.square(d[cut]))
+    return [Circle(centre, r) for centre, r in zip(positions[cut, :2], radius)]
+
+
+def plot_line_collection(trajectories, color_str=None, ax=None, max_points=None):
+    """
+    Batched `plot_lines`: draws the x and y components of every trajectory
+    in the (T, N, 3) array `trajectories` as a single LineCollection, with
+    each trajectory decimated to `max_points` points (by default, the
+    width of the axes in pixels). Returns the collection.
+    """
+    ax = ax if ax is not None else plt.gca()
+    max_points = max_points if max_points is not None else screen_points(ax)
+    lines = LineCollection(_segments(trajectories, max_points), colors=color_str if color_str is not None else 'k')
+    ax.add_collection(lines)
+    return lines
+
+
+def plot_circle_collection(positions, radii, z=0, color_str=None, ax=None):
+    """
+    Batched `plot_circular_objs`: draws the outlines of the spheres at the
+    (N, 3) `positions` with (N,) `radii` in the plane at height `z` as a
+    single PatchCollection. Returns the collection.
+    """
+    ax = ax if ax is not None else plt.gca()
+    circles = PatchCollection(_circles(positions, radii, z), facecolors='none',
+                              edgecolors=color_str if color_str is not None else 'k')
+    ax.add_collection(circles)
+    return circles
+
+
+class EnvironmentRenderer:
+    """
+    Draws an environment as in `plot_env`, but with every kind of body and
+    of trajectory batched into one collection, so that the cost of drawing
+    hardly depends on the number of bodies. `update` redraws the same
+    artists for another time (e.g. the frames of `animate_env`) rather than
+    creating new ones.
+    """
+    def __init__(self, env, ax=None, z=0, potential_field=False, max_points=None):
+        self.env = env
+        self.ax = ax if ax is not None else plt.gca()
+        self.z = z
+        self.max_points = max_points if max_points is not None else screen_points(self.ax)
+
+        ax = self.ax
+        x, y = env.xlen / 2, env.ylen / 2
+        ax.plot([-x, x, x, -x, -x], [-y, -y, y, y, -y], 'k')
+        ax.set_aspect('equal')
+        ax.set_xlabel('x')
+        ax.set_ylabel('y')
+        ax.set_xlim([-x - GRID_OFFSET, x + GRID_OFFSET])
+        ax.set_ylim([-y - GRID_OFFSET, y + GRID_OFFSET])
+
+        self.planets = plot_circle_collection(env.planet_positions, env.planet_radii, z, 'g', ax)
+        self.asteroids = plot_circle_collection(np.empty((0, 3)), np.empty(0), z, 'r', ax)
+        self.spaceships = plot_circle_collection(np.empty((0, 3)), np.empty(0), z, 'b', ax)
+        self.asteroid_lines = plot_line_collection(np.empty((1, 0, 3)), 'r', ax, self.max_points)
+        self.spaceship_lines = plot_line_collection(np.empty((1, 0, 3)), 'b', ax, self.max_points)
+        goals = env.spaceship_goals
+        ax.plot(goals[:, 0], goals[:, 1], 'kD', linestyle='none')
+
+        self.field = None
+        if potential_field:
+            grid = np.linspace(-x, x, RESOLUTION), np.linspace(-y, y, RESOLUTION)
+            X, Y = np.meshgrid(*grid)
+            self._field_points = np.stack([X.ravel(), Y.ravel(), np.full(X.size, float(z))], axis=-1)
+            self.field = ax.quiver(X, Y, np.zeros_like(X), np.zeros_like(Y), units='width')
+
+    def update(self, t=None):
+        """
+        Redraws the bodies, their trajectories so far and the potential field
+        at time `t` (see `Environment.state_at_time`), or at the end of the
+        simulation. Returns the updated artists.
+        """
+        state = self.env.state_at_time(t) if t is not None else self.env
+        asteroid_trajectories = state._asteroid_trajectories.array
+        spaceship_trajectories = state._spaceship_trajectories.array
+
+        self.asteroids.set_paths(_circles(asteroid_trajectories[-1], self.env.asteroid_radii, self.z))
+        self.spaceships.set_paths(_circles(spaceship_trajectories[-1], self.env.spaceship_radii, self.z))
+        self.asteroid_lines.set_segments(_segments(asteroid_trajectories, self.max_points))
+        self.spaceship_lines.set_segments(_segments(spaceship_trajectories, self.max_points))
+        artists = [self.asteroids, self.spaceships, self.asteroid_lines, self.spaceship_lines]
+
+        if self.field is not None:
+            velocity = self.env.navigator.field_at(state, 0, self._field_points)
+            self.field.set_UVC(velocity[:, 0], velocity[:, 1])
+            artists.append(self.field)
+        return artists
+
+
+def plot_env(env, z=0, t=None, potential_field=False, filename=None, batched=False, max_points=None):
+    """
+    Plots the walls, bodies, trajectories and goals of `env` in the plane at
+    height `z`. With `batched`, they are drawn by an EnvironmentRenderer (as
+    of time `t`, if given) with trajectories decimated to `max_points`,
+    which is much faster for many bodies or long runs.
+    """
+    if batched:
+        EnvironmentRenderer(env, z=z, potential_field=potential_field, max_points=max_points).update(t)
+        if filename:
+            plt.savefig(filename)
+        return
+
     plot_walls(env, z=z)
     plot_circular_objs(env.planets, z=z, color_str='g')
     plot_circular_objs(env.asteroids, z=z, color_str='r')
     plot_circular_objs(env.spaceships, z=z, color_str='b')
-    plot_lines(env._asteroid_trajectories, color_str='r')
-    plot_lines(env._spaceship_trajectories, color_str='b')
+    plot_lines(env._asteroid_trajectories.array, color_str='r')
+    plot_lines(env._spaceship_trajectories.array, color_str='b')
     plot_goals(env)
 
     if potential_field:
-        plot_potential_field(env, 0, t=t)
+        plot_potential_field(env, 0, z=z, t=t)
     
     if filename:
         plt.savefig(filename)
 
 
+def animate_env(env, filename, times=None, fps=25, z=0, potential_field=False, max_points=None,
+                figsize=None, dpi=100, writer=None):
+    """
+    Renders the run of `env` frame by frame at `times` (by default, every
+    recorded time index) and saves it as an animation to `filename` with
+    the matplotlib `writer` (by default, chosen from the file's extension,
+    e.g. a .gif is written with Pillow). The figure is drawn off screen and
+    one EnvironmentRenderer is updated for every frame, so no display is
+    needed and the artists are reused across frames.
+    """
+    times = env._spaceship_trajectories.times if times is None else np.asarray(times)
+    fig = Figure(figsize=figsize, dpi=dpi)
+    renderer = EnvironmentRenderer(env, ax=fig.add_subplot(), z=z, potential_field=potential_field,
+                                   max_points=max_points)
+    animation = FuncAnimation(fig, lambda t: renderer.update(t), frames=times.tolist(), blit=False)
+    if writer is None and str(filename).endswith('.gif'):
+        writer = 'pillow'
+    animation.save(filename, writer=writer, fps=fps, dpi=dpi)
+
+
 def plot_xy(x, y, xlabel, ylabel, filename=None):
     plt.plot(x, y)
     plt.xlabel(xlabel)